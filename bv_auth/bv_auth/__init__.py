@@ -1,15 +1,22 @@
 import binascii
+from concurrent.futures import ThreadPoolExecutor
+import csv
 import datetime
 import hashlib
+import io
+import json
 import os
-import re
 import secrets
-import subprocess
 from typing import Optional, NoReturn, List
 
 import flask
 import jwt
+import psycopg2
 
+import bv_rest
+from bv_rest import lock_user_roles, refresh_user_roles
+from bv_rest.cache import cached
+import bv_rest.catalog as catalog
 from bv_rest.database import get_cursor
 
 def hash_password(password):
@@ -31,6 +38,163 @@ def verify_password(hashed_password, provided_password):
     pwdhash = binascii.hexlify(pwdhash).decode('ascii')
     return pwdhash == hashed_password
 
+@cached(invalidate_on=['identity'], maxsize=4096)
+def stored_password(login):
+    '''
+    Return the password hash of an identity or None if the login does not
+    exist. Unknown logins are also cached to reject them without hashing
+    nor database access.
+    '''
+    with get_cursor('bv_services') as cur:
+        cur.execute('SELECT password FROM identity WHERE login=%s', [login])
+        row = cur.fetchone()
+        return (row[0] if row else None)
+
+
+identity_fields = ('login', 'password', 'email', 'first_name', 'last_name',
+                   'institution')
+
+def read_identities(lines, content_type):
+    '''
+    Parse identities from the lines of a CSV (with a header line) or
+    NDJSON (one JSON object per line) document. Yield (record number,
+    identity, error message) tuples where message is None for valid
+    identities.
+    '''
+    lines = (line.decode('utf-8', errors='replace') for line in lines)
+    if content_type == 'text/csv':
+        records = csv.DictReader(lines)
+        parse = lambda record: record
+    else:
+        records = (line for line in lines if line.strip())
+        parse = json.loads
+    number = 0
+    while True:
+        number += 1
+        try:
+            record = parse(next(records))
+        except StopIteration:
+            break
+        except Exception as e:
+            yield number, None, f'Invalid record: {e}'
+            continue
+        if not isinstance(record, dict):
+            yield number, None, 'Record must be an object'
+            continue
+        invalid = [k for k in identity_fields
+                   if record.get(k) is not None and not isinstance(record[k], str)]
+        if invalid:
+            yield number, None, 'Value of %s must be a string' % ', '.join(invalid)
+            continue
+        identity = {k: (record.get(k) or None) for k in identity_fields}
+        missing = [k for k in ('login', 'password', 'email') if not identity[k]]
+        if missing:
+            yield number, identity, 'Missing value for %s' % ', '.join(missing)
+        else:
+            yield number, identity, None
+
+
+def import_identities(records, chunk_size=1000):
+    '''
+    Create active identities from read_identities() records. Passwords
+    are hashed in parallel threads (pbkdf2 releases the GIL) and only for
+    logins that do not exist yet. Identities are copied in a staging
+    table and merged with a single statement. Return the list of
+    imported logins and the list of errors.
+    '''
+    errors = []
+    logins = set()
+    staging = io.StringIO()
+    writer = csv.writer(staging, quoting=csv.QUOTE_NONNUMERIC)
+
+    def stage(chunk):
+        with get_cursor('bv_services', readonly=False) as cur:
+            cur.execute('SELECT login FROM identity WHERE login = ANY(%s)',
+                        [[identity['login'] for number, identity in chunk]])
+            existing = set(row[0] for row in cur)
+        new = []
+        for number, identity in chunk:
+            if identity['login'] in existing:
+                errors.append({'record': number,
+                               'login': identity['login'],
+                               'message': 'Login already exists'})
+            else:
+                new.append((number, identity))
+        hashes = executor.map(hash_password, [identity['password'] for number, identity in new])
+        for (number, identity), password_hash in zip(new, hashes):
+            writer.writerow([number, identity['login'], password_hash] +
+                            [identity[k] for k in identity_fields[2:]])
+
+    with ThreadPoolExecutor(os.cpu_count()) as executor:
+        chunk = []
+        for number, identity, error in records:
+            if error is None and identity['login'] in logins:
+                error = 'Duplicate login'
+            if error is not None:
+                errors.append({'record': number,
+                               'login': identity and identity['login'],
+                               'message': error})
+                continue
+            logins.add(identity['login'])
+            chunk.append((number, identity))
+            if len(chunk) == chunk_size:
+                stage(chunk)
+                chunk = []
+        if chunk:
+            stage(chunk)
+
+    staging.seek(0)
+    imported = []
+    with get_cursor('bv_services') as cur:
+        sql = '''CREATE TEMPORARY TABLE identity_import
+                 (
+                     record INT,
+                     login TEXT,
+                     password TEXT,
+                     email TEXT,
+                     first_name TEXT,
+                     last_name TEXT,
+                     institution TEXT
+                 ) ON COMMIT DROP'''
+        cur.execute(sql)
+        # Empty values were replaced by None and written as ""
+        sql = '''COPY identity_import FROM STDIN
+                 WITH (FORMAT csv, FORCE_NULL (email, first_name, last_name, institution))'''
+        cur.copy_expert(sql, staging)
+        # Identities created concurrently since stage() are skipped
+        sql = '''WITH new_identity AS (
+                     INSERT INTO identity (login, password, email, first_name, last_name, institution,
+                                           registration_time, email_verification_time, activation_time)
+                     SELECT login, password, email, first_name, last_name, institution,
+                            %(now)s, %(now)s, %(now)s
+                     FROM identity_import
+                     ON CONFLICT (login) DO NOTHING
+                     RETURNING login
+                 ), new_role AS (
+                     INSERT INTO role (name, description)
+                     SELECT '$' || login, 'role of user ' || login FROM new_identity
+                     ON CONFLICT (name) DO NOTHING
+                 ), new_granting AS (
+                     INSERT INTO granting (role, given_to, inherit)
+                     SELECT 'active', '$' || login, FALSE FROM new_identity
+                     ON CONFLICT DO NOTHING
+                 )
+                 SELECT i.record, i.login, n.login IS NOT NULL
+                 FROM identity_import i
+                 LEFT JOIN new_identity n ON n.login = i.login
+                 ORDER BY i.record'''
+        cur.execute(sql, {'now': datetime.datetime.utcnow()})
+        for number, login, created in cur.fetchall():
+            if created:
+                imported.append(login)
+            else:
+                errors.append({'record': number,
+                               'login': login,
+                               'message': 'Login already exists'})
+    errors.sort(key=lambda error: error['record'])
+    return imported, errors
+
+
 def init_api(api):
     @api.schema
     class NewIdentity:
@@ -52,39 +216,51 @@ def init_api(api):
     @api.path('/public_key')
     def get() -> str:
         '''Return the public key of the authorization server'''
-        return open('/bv_auth/id_rsa.pub').read()
+        return bv_rest.config.public_key
     
-    @api.path('/api_key')
+    @api.path('/api_key', admission='expensive')
     @api.may_abort(401)
     def post(login : str, password : str) -> str:
         '''
         Return an API key for this user to use in api_key header.
         '''
+        password_hash = stored_password(login)
+        # The password is verified without holding a database connection
+        if password_hash is None or not verify_password(password_hash, password):
+            flask.abort(401, 'Invalid login or password')
+        session_id = secrets.token_urlsafe()
+        now = datetime.datetime.utcnow()
         with get_cursor('bv_services') as cur:
-            sql = 'SELECT password FROM identity WHERE login=%s'
-            cur.execute(sql, [login])
-            if cur.rowcount:
-                password_hash = cur.fetchone()[0]
-                if verify_password(password_hash, password):
-                    session_id = secrets.token_urlsafe()
-                    sql = 'DELETE FROM session WHERE login=%s'
-                    cur.execute(sql, [login])
-                    now = datetime.datetime.utcnow()
-                    sql = 'INSERT INTO session (id, login, creation_time) VALUES (%s, %s, %s)'
-                    cur.execute(sql, [session_id, login, now])
-                    now = datetime.datetime.utcnow()
-                    payload = {'sub': session_id,
-                            'iss': 'bv_auth',
-                            'iat': now,
-                            'login': login,
-                            }
-                    private_key = open('/bv_auth/id_rsa').read()
-                    api_key = jwt.encode(payload, private_key, algorithm='RS256').decode('utf8')
-                    return api_key
-        flask.abort(401, 'Invalid login or password')
+            # The password is checked again in case it was changed since
+            # it was cached. The previous session of the user is replaced
+            # by a single row change.
+            sql = '''WITH active_identity AS (
+                         SELECT login FROM identity
+                         WHERE login = %(login)s AND password = %(password)s
+                           AND activation_time IS NOT NULL
+                           AND deactivation_time IS NULL
+                     )
+                     INSERT INTO session (id, login, creation_time)
+                     SELECT %(session_id)s, login, %(now)s FROM active_identity
+                     ON CONFLICT (login) DO UPDATE
+                     SET id = EXCLUDED.id, creation_time = EXCLUDED.creation_time, last_used = NULL'''
+            cur.execute(sql, {'login': login,
+                              'password': password_hash,
+                              'session_id': session_id,
+                              'now': now})
+            if not cur.rowcount:
+                flask.abort(401, 'Invalid login or password')
+        payload = {'sub': session_id,
+                   'iss': 'bv_auth',
+                   'iat': now,
+                   'login': login,
+                   }
+        return jwt.encode(payload, bv_rest.config.private_key, algorithm='RS256').decode('utf8')
 
     @api.path('/sessions')
     @api.require_role('identity_admin')
+    @api.etag()
+    @api.cached(invalidate_on=['session'])
     def get() -> List[str]:
         '''List all identities'''
         with get_cursor('bv_services', as_dict=True) as cur:
@@ -95,6 +271,8 @@ def init_api(api):
     
     @api.path('/identities')
     @api.require_role('identity_admin')
+    @api.etag()
+    @api.cached(invalidate_on=['identity'])
     def get() -> List[Identity]:
         '''List all identities'''
         with get_cursor('bv_services', as_dict=True) as cur:
@@ -103,6 +281,57 @@ def init_api(api):
             return cur.fetchall()
     
     
+    @api.schema
+    class IdentitySearch:
+        identities: List[Identity]
+        next: Optional[str]
+
+    @api.path('/identities/search', admission='read')
+    @api.require_role('identity_admin')
+    def post(query: Optional[str] = None,
+             prefix: Optional[bool] = False,
+             active: Optional[bool] = None,
+             deactivated: Optional[bool] = None,
+             after: Optional[str] = None,
+             limit: Optional[int] = 100) -> IdentitySearch:
+        '''
+        Search identities whose login, email, names or institution
+        contain query (or start with it if prefix is true), ignoring
+        case. active and deactivated filter on the activation and
+        deactivation state. Results are sorted by login and limited to
+        limit identities (at most 1000); the next page is obtained by
+        giving the returned next value in after.
+        '''
+        limit = max(1, min(limit or 100, 1000))
+        where = []
+        parameters = {'limit': limit + 1}
+        if query:
+            pattern = query.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+            parameters['pattern'] = (f'{pattern}%' if prefix else f'%{pattern}%')
+            where.append('(' + ' OR '.join(f'{column} ILIKE %(pattern)s'
+                                           for column in ('login', 'email', 'first_name',
+                                                          'last_name', 'institution')) + ')')
+        if active is not None:
+            where.append('activation_time IS %s' % ('NOT NULL' if active else 'NULL'))
+        if deactivated is not None:
+            where.append('deactivation_time IS %s' % ('NOT NULL' if deactivated else 'NULL'))
+        if after is not None:
+            where.append('login > %(after)s')
+            parameters['after'] = after
+        sql = 'SELECT login, email, first_name, last_name, institution, registration_time, email_verification_time, activation_time, deactivation_time FROM identity'
+        if where:
+            sql += ' WHERE ' + ' AND '.join(where)
+        sql += ' ORDER BY login LIMIT %(limit)s'
+        with get_cursor('bv_services', as_dict=True, readonly=True) as cur:
+            cur.execute(sql, parameters)
+            identities = cur.fetchall()
+        next_login = None
+        if len(identities) > limit:
+            del identities[limit:]
+            next_login = identities[-1]['login']
+        return {'identities': identities, 'next': next_login}
+    
+    
     @api.path('/identities')
     @api.require_role('identity_admin')
     def post(identity : NewIdentity) -> Identity:
@@ -126,34 +355,126 @@ def init_api(api):
         flask.abort(404)
 
 
+    @api.schema
+    class IdentityImportError:
+        record: int
+        login: Optional[str]
+        message: str
+
+    @api.schema
+    class IdentityImport:
+        imported: List[str]
+        errors: List[IdentityImportError]
+
+    @api.path('/identities/import', admission='import', timeout=600)
+    @api.require_role('identity_admin')
+    def post() -> IdentityImport:
+        '''
+        Create active identities from a request body in CSV format
+        (text/csv with a header line) or NDJSON format (one JSON object
+        per line). Each record must have login, password and email
+        values. Records that cannot be imported are returned in errors
+        with their number.
+        '''
+        records = read_identities(flask.request.stream, flask.request.mimetype)
+        imported, errors = import_identities(records)
+        return {'imported': imported, 'errors': errors}
+
+
+    @api.schema
+    class Granting:
+        role: str
+        given_to: str
+        inherit: Optional[bool]
+
+    def change_grantings(sql, grantings):
+        # inherit is optional, a missing or null value means True
+        rows = {(i['role'], i['given_to']): i.get('inherit') is not False for i in grantings}
+        try:
+            with get_cursor('bv_services') as cur:
+                lock_user_roles(cur)
+                cur.execute(sql, [[i[0] for i in rows],
+                                  [i[1] for i in rows],
+                                  [i for i in rows.values()]])
+                count = cur.rowcount
+                refresh_user_roles(cur, set(i[1] for i in rows))
+        except psycopg2.IntegrityError as e:
+            flask.abort(400, e.diag.message_detail or str(e))
+        return count
+
+    @api.path('/grantings')
+    @api.require_role('identity_admin')
+    @api.may_abort(400)
+    def post(grantings: List[Granting]) -> int:
+        '''
+        Give roles (inherit is True by default) and update the roles of
+        all the users concerned. Return the number of created or modified
+        grantings.
+        '''
+        sql = '''INSERT INTO granting (role, given_to, inherit)
+                 SELECT * FROM unnest(%s::text[], %s::text[], %s::bool[])
+                 ON CONFLICT (role, given_to) DO UPDATE SET inherit = EXCLUDED.inherit'''
+        return change_grantings(sql, grantings)
+
+    @api.path('/grantings')
+    @api.require_role('identity_admin')
+    @api.may_abort(400)
+    def delete(grantings: List[Granting]) -> int:
+        '''
+        Remove roles (inherit is ignored) and update the roles of all the
+        users concerned. Return the number of deleted grantings.
+        '''
+        sql = '''DELETE FROM granting
+                 USING unnest(%s::text[], %s::text[], %s::bool[]) AS removed(role, given_to, inherit)
+                 WHERE granting.role = removed.role AND granting.given_to = removed.given_to'''
+        return change_grantings(sql, grantings)
+
+
+    @api.schema
+    class Column:
+        name: str
+        type: str
+        nullable: bool
+        default: Optional[str]
+
+    @api.schema
+    class Index:
+        name: str
+        primary: bool
+        unique: bool
+        definition: str
+
+    @api.schema
+    class Table:
+        name: str
+        row_estimate: int
+        columns: List[Column]
+        indexes: List[Index]
+
+
     @api.path('/databases')
     #@api.require_role('database_admin')
+    @api.etag()
     def get() -> List[str]:
         '''List all dtabases'''
-        with get_cursor('bv_services') as cur:
-            sql = "SELECT datname FROM pg_database WHERE datistemplate IS FALSE AND datname != 'postgres'"
-            cur.execute(sql)
-            return [row[0] for row in cur]
+        return list(catalog.databases())
     
     @api.path('/databases/<database>/tables')
     #@api.require_role('database_admin')
-    def get(database: str) -> List[str]:
-        '''List all tables of a database'''
-        with get_cursor('bv_services') as cur:
-            sql = '''SELECT schemaname, tablename 
-                     FROM pg_tables 
-                     WHERE schemaname NOT IN ('pg_catalog', 
-                                              'information_schema')'''
-            cur.execute(sql)
-            return [(row[1] if row[0] == 'public' else f'{row[0]}.{row[1]}') for row in cur]
+    @api.may_abort(404)
+    @api.etag()
+    def get(database: str) -> List[Table]:
+        '''List all tables of a database with their columns and indexes'''
+        if database not in catalog.databases():
+            flask.abort(404, f'No such database: {database}')
+        return catalog.tables(database)
     
 
     @api.path('/databases/<database>/schema')
     #@api.require_role('database_admin')
+    @api.may_abort(404)
     def get(database: str) -> str:
         '''Return the schema of a database in SQL format'''
-        output = subprocess.check_output([
-            'docker', 'exec', 'bv_postgres', 'pg_dump','-U', 
-            flask.current_app.postgres_user, '-d', 'bv_services', '-s'])
-        return re.sub(r'^--[^\n]*\n', '', output.decode('utf8'), 0, re.MULTILINE).strip().replace('\n\n\n', '\n\n')
-    
+        if database not in catalog.databases():
+            flask.abort(404, f'No such database: {database}')
+        return catalog.schema_ddl(database)
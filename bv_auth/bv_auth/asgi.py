@@ -0,0 +1,8 @@
+'''This is the ASGI entry point for bv_auth. It can be used with any
+ASGI server, for instance: uvicorn bv_auth.asgi:application
+'''
+
+import bv_rest.asgi
+from bv_auth.wsgi import application as flask_application
+
+application = bv_rest.asgi.ASGIApplication(flask_application.rest_api)
@@ -60,6 +60,7 @@ def create_app(test_config=None):
 
     bv_rest.init_api(api)
     bv_auth.init_api(api)
+    api.warm_up()
 
     return app
 
@@ -29,11 +29,11 @@ setup(
         'gunicorn',
         #'pgpy',
     ],
-    #extras_require={
-        #'testing': [
+    extras_require={
+        'testing': [
             ##'WebTest >= 1.3.1',  # py3 compat
-            ##'pytest',
+            'pytest',
             ##'pytest-cov',
-        #],
-    #},
+        ],
+    },
 )
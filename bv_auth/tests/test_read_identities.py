@@ -0,0 +1,39 @@
+import json
+
+from bv_auth import read_identities
+
+
+def ndjson(*records):
+    return [(json.dumps(r) if not isinstance(r, str) else r).encode('utf8') + b'\n'
+            for r in records]
+
+
+def test_read_csv():
+    lines = [b'login,password,email,institution\n',
+             b'bob,secret,bob@example.org,"Inst, Inc"\n',
+             b'alice,,alice@example.org,\n']
+    records = list(read_identities(lines, 'text/csv'))
+    assert records[0][0] == 1
+    assert records[0][1]['login'] == 'bob'
+    assert records[0][1]['institution'] == 'Inst, Inc'
+    assert records[0][1]['first_name'] is None
+    assert records[0][2] is None
+    assert records[1][0] == 2
+    assert records[1][2] == 'Missing value for password'
+
+
+def test_read_ndjson():
+    lines = ndjson({'login': 'bob', 'password': 'secret', 'email': 'bob@example.org'},
+                   '{invalid',
+                   '',
+                   [1],
+                   {'login': 'alice', 'password': 123, 'email': 'alice@example.org'},
+                   {'login': 'carol'})
+    records = list(read_identities(lines, 'application/x-ndjson'))
+    assert [r[0] for r in records] == [1, 2, 3, 4, 5]
+    assert records[0][1]['login'] == 'bob' and records[0][2] is None
+    assert records[1][1] is None and records[1][2].startswith('Invalid record')
+    assert records[2][2] == 'Record must be an object'
+    assert records[3][1] is None
+    assert records[3][2] == 'Value of password must be a string'
+    assert records[4][2] == 'Missing value for password, email'
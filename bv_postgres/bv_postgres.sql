@@ -12,6 +12,14 @@ CREATE TABLE identity
     deactivation_time TIMESTAMP
 );
 
+-- Trigram indexes used by identity search (ILIKE on substrings)
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
+CREATE INDEX identity_login_trgm ON identity USING gin (login gin_trgm_ops);
+CREATE INDEX identity_email_trgm ON identity USING gin (email gin_trgm_ops);
+CREATE INDEX identity_first_name_trgm ON identity USING gin (first_name gin_trgm_ops);
+CREATE INDEX identity_last_name_trgm ON identity USING gin (last_name gin_trgm_ops);
+CREATE INDEX identity_institution_trgm ON identity USING gin (institution gin_trgm_ops);
+
 
 CREATE TABLE role
 (
@@ -30,7 +38,7 @@ CREATE TABLE granting
 CREATE TABLE session
 (
     id TEXT PRIMARY KEY,
-    login TEXT NOT NULL REFERENCES identity ON UPDATE CASCADE,
+    login TEXT NOT NULL UNIQUE REFERENCES identity ON UPDATE CASCADE,
     creation_time TIMESTAMP,
     last_used TIMESTAMP
 );
@@ -41,12 +49,97 @@ CREATE TABLE user_roles_cache
     roles TEXT[]
 );
 
+-- Notify listeners of table changes. The notification invalidates caches
+-- in all the worker processes.
+CREATE FUNCTION table_changed() RETURNS trigger AS $$
+BEGIN
+    PERFORM pg_notify('table_changed', TG_TABLE_NAME);
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER identity_changed AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON identity
+    FOR EACH STATEMENT EXECUTE PROCEDURE table_changed();
+CREATE TRIGGER role_changed AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON role
+    FOR EACH STATEMENT EXECUTE PROCEDURE table_changed();
+CREATE TRIGGER granting_changed AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON granting
+    FOR EACH STATEMENT EXECUTE PROCEDURE table_changed();
+CREATE TRIGGER session_changed AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON session
+    FOR EACH STATEMENT EXECUTE PROCEDURE table_changed();
+
+-- Notify the key of each modified row to the /events change feed. The
+-- trigger arguments are the names of the key columns. Sessions are
+-- identified by their login because session ids are secret.
+CREATE FUNCTION row_changed() RETURNS trigger AS $$
+DECLARE
+    row_json JSONB;
+    key JSONB := '{}';
+    key_column TEXT;
+BEGIN
+    IF TG_OP = 'DELETE' THEN
+        row_json := to_jsonb(OLD);
+    ELSE
+        row_json := to_jsonb(NEW);
+    END IF;
+    FOREACH key_column IN ARRAY TG_ARGV LOOP
+        key := key || jsonb_build_object(key_column, row_json -> key_column);
+    END LOOP;
+    PERFORM pg_notify('row_changed', json_build_object('table', TG_TABLE_NAME,
+                                                       'operation', TG_OP,
+                                                       'key', key)::text);
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER identity_row_changed AFTER INSERT OR UPDATE OR DELETE ON identity
+    FOR EACH ROW EXECUTE PROCEDURE row_changed('login');
+CREATE TRIGGER granting_row_changed AFTER INSERT OR UPDATE OR DELETE ON granting
+    FOR EACH ROW EXECUTE PROCEDURE row_changed('role', 'given_to');
+CREATE TRIGGER session_row_changed AFTER INSERT OR UPDATE OR DELETE ON session
+    FOR EACH ROW EXECUTE PROCEDURE row_changed('login');
+
 
 INSERT INTO role VALUES ('identity_admin', 'can read or modify any identity');
 INSERT INTO role VALUES ('active', 'this role is given to all active users');
 
-INSERT INTO identity (login, password) VALUES ('admin', 'b6540e4c524891f55fd61b7b9b6f745ff227e8a6946cc0ce5d184a46676399443225769481bdf15918fe9f4f7f436f611c620fb6ee447890975510012d2cb772fc660960b484f4315e881e1cd0bf3f33f8a441ca73683cd6d04eb2dde9c75603');
+INSERT INTO identity (login, password, activation_time) VALUES ('admin', 'b6540e4c524891f55fd61b7b9b6f745ff227e8a6946cc0ce5d184a46676399443225769481bdf15918fe9f4f7f436f611c620fb6ee447890975510012d2cb772fc660960b484f4315e881e1cd0bf3f33f8a441ca73683cd6d04eb2dde9c75603', now() AT TIME ZONE 'utc');
 INSERT INTO role VALUES ('$admin', 'role of user admin');
 
 INSERT INTO granting VALUES ('identity_admin', '$admin', TRUE);
 INSERT INTO granting VALUES ('active', '$admin', FALSE);
+
+
+-- Notify listeners of schema changes to invalidate catalog caches. The
+-- event trigger is also created in template1 to be inherited by new
+-- databases.
+CREATE FUNCTION ddl_changed() RETURNS event_trigger AS $$
+BEGIN
+    -- Temporary tables (e.g. for identity imports) are not cached.
+    -- Commands such as DROP report no object and always notify.
+    IF NOT EXISTS (SELECT FROM pg_event_trigger_ddl_commands())
+       OR EXISTS (SELECT FROM pg_event_trigger_ddl_commands()
+                  WHERE schema_name IS NULL OR schema_name NOT LIKE 'pg\_temp%') THEN
+        PERFORM pg_notify('ddl_changed', current_database());
+    END IF;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE EVENT TRIGGER ddl_changed ON ddl_command_end
+    EXECUTE PROCEDURE ddl_changed();
+
+\connect template1
+
+CREATE FUNCTION ddl_changed() RETURNS event_trigger AS $$
+BEGIN
+    -- Temporary tables (e.g. for identity imports) are not cached.
+    -- Commands such as DROP report no object and always notify.
+    IF NOT EXISTS (SELECT FROM pg_event_trigger_ddl_commands())
+       OR EXISTS (SELECT FROM pg_event_trigger_ddl_commands()
+                  WHERE schema_name IS NULL OR schema_name NOT LIKE 'pg\_temp%') THEN
+        PERFORM pg_notify('ddl_changed', current_database());
+    END IF;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE EVENT TRIGGER ddl_changed ON ddl_command_end
+    EXECUTE PROCEDURE ddl_changed();
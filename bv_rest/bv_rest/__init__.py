@@ -1,20 +1,34 @@
+import asyncio
+import contextvars
 import datetime
 from collections import OrderedDict
 from functools import partial, wraps
+import hashlib
 import inspect
+import os
 import os.path as osp
 import re
+import threading
+import time
 import traceback
 import typing
+from typing import List
 import uuid
 
 from flask import (jsonify, request, abort, make_response,
                    render_template_string, send_from_directory,
-                   has_request_context)
+                   has_request_context, g, json, Response,
+                   stream_with_context)
 import jwt
-from  werkzeug.exceptions import HTTPException, HTTP_STATUS_CODES
+import psycopg2.extensions
+from werkzeug.exceptions import HTTPException
+from werkzeug.http import HTTP_STATUS_CODES
+from werkzeug.routing import Map, Rule
 
-from bv_rest.database import get_cursor
+from bv_rest.admission import AdmissionClass, default_admission_classes
+from bv_rest.cache import cached
+from bv_rest.database import get_cursor, get_pool, transaction
+from bv_rest.events import EventHub, event_stream
 
 class ServicesConfig:
     @property
@@ -31,47 +45,170 @@ class ServicesConfig:
     def postgres_password(self):
         return open(osp.join(self.services_dir, 'postgres_password')).read()
 
+    _keys = {}
+
+    def read_key(self, name):
+        # Keys are read once, before workers are forked if warm_up()
+        # is used.
+        key = self._keys.get(name)
+        if key is None:
+            key = self._keys[name] = open(osp.join('/bv_auth', name)).read()
+        return key
+
+    @property
+    def public_key(self):
+        return self.read_key('id_rsa.pub')
+
+    @property
+    def private_key(self):
+        return self.read_key('id_rsa')
+
+    def load_keys(self):
+        for name in ('id_rsa.pub', 'id_rsa'):
+            if osp.exists(osp.join('/bv_auth', name)):
+                self.read_key(name)
+
+    @property
+    def threads(self):
+        # Number of threads serving requests in a process. It is also
+        # used by gunicorn_config.
+        return int(os.environ.get('BV_THREADS', '4'))
+
+    @property
+    def event_streams(self):
+        # Maximum number of /events streams in a process. Each stream
+        # has its own thread in addition to the threads serving requests.
+        return int(os.environ.get('BV_EVENT_STREAMS', '16'))
+
+    @property
+    def drain_file(self):
+        # This file is created when the server is stopping to make
+        # readiness probes fail while requests are still served.
+        return os.environ.get('BV_DRAIN_FILE', '/tmp/bv_rest_draining')
+
+    @property
+    def postgres_host(self):
+        # Optional file containing the primary server as host[:port]
+        path = osp.join(self.services_dir, 'postgres_host')
+        if osp.exists(path):
+            return open(path).read().strip()
+        return 'bv_postgres'
+
+    @property
+    def postgres_replicas(self):
+        # Optional file containing one read replica host[:port] per line
+        path = osp.join(self.services_dir, 'postgres_replicas')
+        if osp.exists(path):
+            return open(path).read().split()
+        return []
+
 
 config = ServicesConfig()
 
+
+class NotModified(Exception):
+    '''
+    Raised by an operation to send a 304 (Not Modified) response
+    '''
+    def __init__(self, etag):
+        super().__init__(etag)
+        self.etag = etag
+
+
+async def run_in_thread(function, *args, **kwargs):
+    '''
+    Run a blocking function from a coroutine in the default executor
+    of the event loop. The current context (e.g. Flask request) is
+    kept.
+    '''
+    loop = asyncio.get_event_loop()
+    context = contextvars.copy_context()
+    return await loop.run_in_executor(None, partial(context.run, function, *args, **kwargs))
+
+
+# Compute the roles of the users returned by a {logins} query: their
+# personal role and the roles granted to it, recursively following
+# the roles that were given with inherit. Results are stored in
+# user_roles_cache.
+_user_roles_sql = '''WITH RECURSIVE closure(login, role, inherit) AS (
+                         SELECT login, '$' || login, TRUE FROM ({logins}) AS logins
+                       UNION
+                         SELECT closure.login, granting.role, granting.inherit
+                         FROM closure
+                         JOIN granting ON granting.given_to = closure.role
+                         WHERE closure.inherit
+                     )
+                     INSERT INTO user_roles_cache (login, roles)
+                     SELECT login, array_agg(DISTINCT role) FROM closure GROUP BY login
+                     ON CONFLICT (login) DO UPDATE SET roles = EXCLUDED.roles
+                     RETURNING roles'''
+
+# Key of the advisory lock serializing the modifications of grantings
+# and of user_roles_cache
+_user_roles_lock = 0x62765f726f6c6573
+
+
+def lock_user_roles(cur):
+    '''
+    Wait for other transactions modifying grantings or user_roles_cache
+    until the end of the current transaction. Under READ COMMITTED, the
+    following statements see all their changes, so that the cache
+    cannot be computed from outdated grantings (e.g. keeping a revoked
+    role). It must be called before modifying grantings.
+    '''
+    cur.execute('SELECT pg_advisory_xact_lock(%s)', [_user_roles_lock])
+
+
+@cached(invalidate_on=['granting', 'role', 'identity'])
+def user_roles(login):
+    '''
+    Return the roles of a user. Unknown and deactivated identities have
+    no role.
+    '''
+    with get_cursor('bv_services', readonly=False) as cur:
+        sql = ('''SELECT identity.deactivation_time IS NULL, user_roles_cache.roles
+                  FROM identity
+                  LEFT JOIN user_roles_cache ON user_roles_cache.login = identity.login
+                  WHERE identity.login=%s''')
+        cur.execute(sql, [login])
+        row = cur.fetchone()
+        if row is None or not row[0]:
+            return frozenset()
+        roles = row[1]
+        if roles is None:
+            lock_user_roles(cur)
+            cur.execute(_user_roles_sql.format(logins='SELECT %s AS login'), [login])
+            roles = cur.fetchone()[0]
+        return frozenset(roles)
+
+
+def refresh_user_roles(cur, roles):
+    '''
+    Recompute with a single query the cached roles of all the users
+    having one of the given roles. It must be called with the cursor
+    used to modify the grantings given to these roles, after
+    lock_user_roles().
+    '''
+    logins = 'SELECT login FROM user_roles_cache WHERE roles && %s::text[]'
+    cur.execute(_user_roles_sql.format(logins=logins), [list(roles)])
+
+
 def get_roles():
-    token = request.headers.get('api_key')
-    if token:
-        public_key = open('/bv_auth/id_rsa.pub').read()
+    '''
+    Return the roles of the user identified by the api_key header. They
+    are resolved once per request (e.g. for all operations of a batch).
+    '''
+    if 'roles' not in g:
+        token = request.headers.get('api_key')
+        if not token:
+            abort(401)
         try:
-            payload = jwt.decode(token, public_key, issuer='bv_auth', algorithm='RS256')
+            payload = jwt.decode(token, config.public_key, issuer='bv_auth', algorithm='RS256')
         except:
             abort(401)
-        login = payload.get('login')
-        sql = 'SELECT roles FROM user_roles_cache WHERE login=%s'
-        cursor.execute(sql, [login])
-        if cursor.rowcount:
-            return set(cursor.fetchone()[0])
-        else:
-            sql = 'SELECT role, given_to, inherit FROM granting'
-            cur.execute(sql)
-            grantings = {}
-            links = {}
-            for role, given_to, inherit in cur:
-                grantings.setdefault(given_to, set()).add(role)
-                if inherit:
-                    links.setdefault(given_to, set()).add(role)
-            user_role = f'${login}'
-            roles = {user_role}
-            roles.update(grantings.get(user_role, set()))
-            new_roles = set()
-            while True:
-                for role in roles:
-                    new_roles.add(role)
-                    for linked_role in links.get(role, set()):
-                        new_roles.update(grantings.get(linked_role, set()))
-                if new_roles == roles:
-                    break
-                roles = new_roles
-            sql = 'INSERT INTO user_roles_cache (login, roles) VALUES (%s, %s)'
-            cursor.execute(sql, [login, list(roles)])
-            return roles
-    abort(401)
+        g.login = payload.get('login')
+        g.roles = user_roles(g.login)
+    return g.roles
 
 class RestAPI:
     class Path:
@@ -86,10 +223,12 @@ class RestAPI:
             self.delete = None
             
     class Operation:
-        def __init__(self, api, path):
+        def __init__(self, api, path, admission=None, timeout=None):
             self.api = api
             self.path = path
             self.param_in_body = False
+            self.admission = admission
+            self.timeout = timeout
             
         def __call__(self, function=None, 
                      param_in_body=False):
@@ -104,13 +243,21 @@ class RestAPI:
                 if getattr(self.path, http_method) is not None:
                     raise NameError('A function is already defined for HTTP method %s on route %s' % (method, self.path))
                 
+                if getattr(function, 'has_etag', False) and http_method != 'get':
+                    raise ValueError('ETag can only be used on get operations')
                 function.param_in_body = self.param_in_body
+                if self.admission is None:
+                    self.admission = ('read' if http_method == 'get' else 'default')
+                admission = self.api.admission_classes[self.admission]
                 setattr(self.path, http_method, function)
+                self.api._open_api = None
+                self.api._url_map = None
                 
-                argspec = inspect.getfullargspec(function)
+                argspec = inspect.getfullargspec(inspect.unwrap(function))
                 json_args = [i for i in argspec.args if i not in self.path.path_parameters]
                 function.json_args = json_args
                 function.path_parameters = self.path.path_parameters
+                function.operation = self
                 
                 @self.api.flask_app.route(self.path.path, 
                                           endpoint=self.id,
@@ -118,55 +265,141 @@ class RestAPI:
                 @wraps(function)
                 def wrapper(**kwargs):
                     if request.method == 'OPTIONS':
-                        # Handle options is necessary to allow web pages that
-                        # are not on the same server (e.g. local pages) to use 
-                        # the API. See 
-                        # https://www.html5rocks.com/en/tutorials/cors/
-                        acrh = request.headers['Access-Control-Request-Headers']
-                        response = make_response('', 200)
-                        response.headers['Access-Control-Allow-Origin'] = '*'
-                        response.headers['Access-Control-Allow-Methods'] = 'GET,PUT,POST'
-                        response.headers['Access-Control-Allow-Headers'] = acrh
+                        response = self.options_response()
+                    elif inspect.iscoroutinefunction(function):
+                        error = {
+                            'message': 'This operation is only available in ASGI mode',
+                        }
+                        response = make_response(error, 501)
+                    elif not admission.acquire(self.start_deadline(admission)):
+                        response = self.overload_response(admission)
                     else:
+                        # See RestAPI.dispatch()
+                        g.admission = self.admission
                         try:
-                            response = None
-                            args = ()
-                            try:
-                                if function.param_in_body:
-                                    args = (request.get_json(force=True),)
-                                elif function.json_args:
-                                    kwargs.update(request.get_json(force=True))
-                            except Exception as e:
-                                error = {
-                                    'message': 'Request does not contain valid JSON',
-                                }
-                                response = make_response(error, 400)
+                            args, kwargs, response = self.parse_arguments(function, kwargs)
                             if response is None:
-                                result = function(*args, **kwargs)
-                                try:
-                                    response = jsonify(result)
-                                except Exception as e:
-                                    error = {
-                                        'message': 'Value cannot be converted to JSON (%s): %s' % (str(e), repr(result)),
-                                        'traceback': traceback.format_exc(),
-                                    }
-                                    response = make_response(error, 500)
-                        except HTTPException as e:
-                            error = {
-                                'message': str(e),
-                            }
-                            response = make_response(error, e.code)
+                                response = self.result_response(function(*args, **kwargs))
                         except Exception as e:
-                            error = {
-                                'message': '%s: %s' % (e.__class__.__name__, str(e)),
-                                'traceback': traceback.format_exc(),
-                            }
-                            response = make_response(error, 500)
-                    response.headers['Access-Control-Allow-Origin'] = '*'
-                    return response
+                            response = self.exception_response(e)
+                        finally:
+                            admission.release()
+                    return self.finalize_response(response)
                 
+                @wraps(function)
+                async def async_wrapper(**kwargs):
+                    queue_timeout = self.start_deadline(admission)
+                    if not (admission.try_acquire() or
+                            await run_in_thread(admission.acquire, queue_timeout)):
+                        return self.finalize_response(self.overload_response(admission))
+                    g.admission = self.admission
+                    try:
+                        args, kwargs, response = self.parse_arguments(function, kwargs)
+                        if response is None:
+                            response = self.result_response(await function(*args, **kwargs))
+                    except Exception as e:
+                        response = self.exception_response(e)
+                    finally:
+                        admission.release()
+                    return self.finalize_response(response)
+                function.async_wrapper = async_wrapper
+
                 return function
 
+        def start_deadline(self, admission):
+            '''
+            Set the deadline of the current request and return the
+            maximum time to wait for admission.
+            '''
+            timeout = (self.api.default_timeout if self.timeout is None
+                       else self.timeout)
+            if not timeout:
+                g.deadline = None
+                return admission.queue_timeout
+            g.deadline = time.monotonic() + timeout
+            return min(admission.queue_timeout, timeout)
+
+        def options_response(self):
+            # Handle options is necessary to allow web pages that
+            # are not on the same server (e.g. local pages) to use 
+            # the API. See 
+            # https://www.html5rocks.com/en/tutorials/cors/
+            acrh = request.headers['Access-Control-Request-Headers']
+            response = make_response('', 200)
+            response.headers['Access-Control-Allow-Origin'] = '*'
+            response.headers['Access-Control-Allow-Methods'] = 'GET,PUT,POST,DELETE'
+            response.headers['Access-Control-Allow-Headers'] = acrh
+            return response
+
+        def parse_arguments(self, function, kwargs):
+            '''
+            Return positional and keyword arguments for an operation
+            function and an error response if the request is invalid.
+            '''
+            args = ()
+            try:
+                if function.param_in_body:
+                    args = (request.get_json(force=True),)
+                elif function.json_args:
+                    kwargs.update(request.get_json(force=True))
+            except Exception as e:
+                error = {
+                    'message': 'Request does not contain valid JSON',
+                }
+                return args, kwargs, make_response(error, 400)
+            return args, kwargs, None
+
+        def result_response(self, result):
+            if isinstance(result, Response):
+                # e.g. a streamed response
+                return result
+            try:
+                response = jsonify(result)
+            except Exception as e:
+                error = {
+                    'message': 'Value cannot be converted to JSON (%s): %s' % (str(e), repr(result)),
+                    'traceback': traceback.format_exc(),
+                }
+                return make_response(error, 500)
+            etag = g.pop('etag', None)
+            if etag is not None:
+                response.set_etag(etag)
+            return response
+
+        def exception_response(self, e):
+            if isinstance(e, NotModified):
+                response = make_response('', 304)
+                response.set_etag(e.etag)
+                return response
+            if isinstance(e, psycopg2.extensions.QueryCanceledError):
+                error = {
+                    'message': 'Operation deadline exceeded: %s' % str(e).strip(),
+                }
+                return make_response(error, 504)
+            if isinstance(e, HTTPException):
+                error = {
+                    'message': str(e),
+                }
+                return make_response(error, e.code)
+            error = {
+                'message': '%s: %s' % (e.__class__.__name__, str(e)),
+                'traceback': traceback.format_exc(),
+            }
+            return make_response(error, 500)
+
+        def overload_response(self, admission):
+            error = {
+                'message': f'Too many concurrent requests ({admission.name})',
+            }
+            response = make_response(error, 503)
+            response.headers['Retry-After'] = str(admission.retry_after)
+            return response
+
+        def finalize_response(self, response):
+            response.headers['Access-Control-Allow-Origin'] = '*'
+            response.headers['Access-Control-Expose-Headers'] = 'ETag'
+            return response
+
     def __init__(self, flask_app, title, description, version):
         self.flask_app = flask_app
         self.title = title
@@ -174,29 +407,192 @@ class RestAPI:
         self.version = version
         self.schemas = []
         self.paths = OrderedDict()
+        self._open_api = None
+        self._url_map = None
+        self.default_timeout = flask_app.config.get('OPERATION_TIMEOUT', 30)
+        self.admission_classes = {}
+        threads = flask_app.config.get('THREADS', config.threads)
+        connections = flask_app.config.get('POSTGRES_MAX_CONNECTIONS', threads)
+        event_streams = flask_app.config.get('EVENT_STREAMS', config.event_streams)
+        for name, parameters in default_admission_classes(threads, connections, event_streams).items():
+            parameters.update(flask_app.config.get('ADMISSION_CLASSES', {}).get(name, {}))
+            self.add_admission_class(name, **parameters)
+        flask_app.rest_api = self
 
     def schema(self, cls):
         self.schemas.append(cls)
+        self._open_api = None
         return cls
 
-    def path(self, path):
+    def add_admission_class(self, name, max_concurrency, max_queue=0,
+                            queue_timeout=1, retry_after=1):
+        self.admission_classes[name] = AdmissionClass(name,
+            max_concurrency=max_concurrency,
+            max_queue=max_queue,
+            queue_timeout=queue_timeout,
+            retry_after=retry_after)
+
+    def path(self, path, admission=None, timeout=None):
+        '''
+        Declare an operation on a path. admission is the name of the
+        admission class limiting concurrent executions of the
+        operation (by default 'read' for get and 'default' otherwise).
+        timeout is the maximum duration of the operation in seconds
+        (by default the OPERATION_TIMEOUT configuration value, 0 for no
+        limit). It is enforced with a statement_timeout on database
+        queries and the operation returns a 504 error on expiration.
+        '''
         path_obj = self.paths.get(path)
         if not path_obj:
             path_obj = self.Path(path)
             self.paths[path] = path_obj
-        return self.Operation(self, path_obj)
+        return self.Operation(self, path_obj, admission=admission,
+                              timeout=timeout)
     
+    def dispatch(self, method, path, body=None):
+        '''
+        Execute an operation in the current request context and return
+        its response. It is used to run several operations in a single
+        HTTP request. Path parameters are taken from path and other
+        parameters from body. An operation of another admission class
+        than the request also needs a slot in its class (without
+        waiting, a 503 response is returned otherwise). Its timeout can
+        only shorten the deadline of the request.
+        '''
+        if self._url_map is None:
+            rules = []
+            for path_obj in self.paths.values():
+                for http_method in ('get', 'post', 'put', 'delete'):
+                    function = getattr(path_obj, http_method)
+                    if function is not None:
+                        rules.append(Rule(path_obj.path, endpoint=function,
+                                          methods=[http_method.upper()]))
+            self._url_map = Map(rules)
+        try:
+            function, kwargs = self._url_map.bind('localhost').match(path, method=method.upper())
+        except HTTPException as e:
+            return make_response({'message': str(e)}, e.code)
+        operation = function.operation
+        if inspect.iscoroutinefunction(function):
+            error = {
+                'message': 'This operation is only available in ASGI mode',
+            }
+            return make_response(error, 501)
+        admission = None
+        if operation.admission != g.get('admission'):
+            # The request already holds a slot, waiting could deadlock
+            admission = self.admission_classes[operation.admission]
+            if not admission.try_acquire():
+                return operation.overload_response(admission)
+        deadline = g.get('deadline')
+        timeout = (self.default_timeout if operation.timeout is None
+                   else operation.timeout)
+        if timeout:
+            g.deadline = min(time.monotonic() + timeout, deadline or float('inf'))
+        try:
+            args = ()
+            if function.param_in_body:
+                args = (body,)
+            elif function.json_args:
+                if not isinstance(body, dict):
+                    error = {
+                        'message': 'Request body must be a JSON object',
+                    }
+                    return make_response(error, 400)
+                kwargs.update(body)
+            response = operation.result_response(function(*args, **kwargs))
+            if response.is_streamed:
+                response.close()
+                error = {
+                    'message': 'Streamed responses cannot be dispatched',
+                }
+                return make_response(error, 400)
+            return response
+        except Exception as e:
+            return operation.exception_response(e)
+        finally:
+            g.deadline = deadline
+            if admission is not None:
+                admission.release()
+
     def require_role(self, role):
         def decorator(function):
             function.has_security = True
-            @wraps(function)
-            def wrapper(*args, **kwargs):
-                if role not in get_roles():
-                    abort(403)
-                return function(*args, **kwargs)
+            if inspect.iscoroutinefunction(function):
+                @wraps(function)
+                async def wrapper(*args, **kwargs):
+                    if role not in await run_in_thread(get_roles):
+                        abort(403)
+                    return await function(*args, **kwargs)
+            else:
+                @wraps(function)
+                def wrapper(*args, **kwargs):
+                    if role not in get_roles():
+                        abort(403)
+                    return function(*args, **kwargs)
             return self.may_abort(401)(self.may_abort(403)(wrapper))
         return decorator
             
+    def etag(self, version=None):
+        '''
+        Decorator adding conditional GET support to an operation. version
+        is called with the operation parameters and must return a cheap
+        value that changes whenever the result changes. If the client
+        sends this value in If-None-Match, a 304 response is returned
+        without calling the operation. If version is None, the ETag is
+        a hash of the result; it saves bandwidth but not computation.
+        Combined with cached(), the hash is computed once per cached
+        result and always changes with the result.
+        '''
+        def check(etag):
+            # If-None-Match uses the weak comparison (RFC 7232), proxies
+            # may add a W/ prefix to the tags of compressed responses.
+            if request.if_none_match.contains_weak(etag):
+                raise NotModified(etag)
+            g.etag = etag
+
+        # Last result (a shared cached value) and its hash
+        last = [(None, None)]
+
+        def result_etag(result):
+            last_result, etag = last[0]
+            if result is not last_result or result is None:
+                etag = hashlib.sha1(json.dumps(result, sort_keys=True).encode('utf8')).hexdigest()
+                last[0] = (result, etag)
+            return etag
+
+        def decorator(function):
+            function.has_etag = True
+            if inspect.iscoroutinefunction(function):
+                @wraps(function)
+                async def wrapper(*args, **kwargs):
+                    if version is None:
+                        result = await function(*args, **kwargs)
+                        check(result_etag(result))
+                        return result
+                    check(str(await run_in_thread(version, *args, **kwargs)))
+                    return await function(*args, **kwargs)
+            else:
+                @wraps(function)
+                def wrapper(*args, **kwargs):
+                    if version is None:
+                        result = function(*args, **kwargs)
+                        check(result_etag(result))
+                        return result
+                    check(str(version(*args, **kwargs)))
+                    return function(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def cached(self, ttl=None, key=None, invalidate_on=(), maxsize=1024):
+        '''
+        Decorator storing operation results in a per process LRU cache.
+        Entries expire after ttl seconds (if not None) and are cleared
+        in all processes when a table of invalidate_on is modified.
+        '''
+        return cached(ttl=ttl, key=key, invalidate_on=invalidate_on,
+                      maxsize=maxsize)
+
     def may_abort(self, http_code):
         def decorator(function):
             if http_code not in HTTP_STATUS_CODES:
@@ -207,8 +603,25 @@ class RestAPI:
             return function
         return decorator
         
+    def warm_up(self):
+        '''
+        Build everything that can be shared by all worker processes
+        before they are forked (OpenAPI specification and keys).
+        '''
+        self.open_api
+        config.load_keys()
+
     @property
     def open_api(self):
+        if self._open_api is None:
+            self._open_api = self.build_open_api()
+        if has_request_context():
+            result = OrderedDict(self._open_api)
+            result['servers'] = [{'url': f'{request.headers["X-Forwarded-Proto"]}://{request.headers["X-Forwarded-Host"]}{request.headers["X-Forwarded-Prefix"]}'}]
+            return result
+        return self._open_api
+
+    def build_open_api(self):
         result = OrderedDict([
             ('openapi', '3.0.2'),
             ('info', OrderedDict([
@@ -241,9 +654,6 @@ class RestAPI:
                 ])),
             ])),
         ])
-        if has_request_context():
-            result['servers'] = [{'url': f'{request.headers["X-Forwarded-Proto"]}://{request.headers["X-Forwarded-Host"]}{request.headers["X-Forwarded-Prefix"]}'}]
-            
         for cls in self.schemas:
             if len(cls.__bases__) != 1:
                 raise TypeError('Open API implementation does not support multiple inheritance')
@@ -287,7 +697,7 @@ class RestAPI:
                     operation = OrderedDict()
                     path_dict[http_method] = operation
                     operation['summary'] = function.__doc__
-                    argspec = inspect.getfullargspec(function)
+                    argspec = inspect.getfullargspec(inspect.unwrap(function))
                     args = [i for i in argspec.args if i not in path.path_parameters]
                     if getattr(function, 'has_security', False):
                         operation['security'] = [OrderedDict([('api_key', [])])]
@@ -330,6 +740,8 @@ class RestAPI:
                             ('description', 'Unexpected error'),
                             ('content', {'application/json': {'schema': {'$ref': '#/components/schemas/Exception'}}}),
                         ])
+                    if getattr(function, 'has_etag', False):
+                        responses['304'] = {'description': HTTP_STATUS_CODES[304]}
                     return_type = function.__annotations__.get('return')
                     if return_type is typing.NoReturn:
                         operation['responses']['204'] = {'description': 'Success'}
@@ -341,6 +753,7 @@ class RestAPI:
         return result
     
     _type_to_open_api = {
+        bool: ('boolean', None),
         str: ('string', None),
         bytes: ('string', 'byte'),
         int: ('integer', 'int64'),
@@ -351,6 +764,9 @@ class RestAPI:
 
     def type_to_open_api(self, type_def):
         result = OrderedDict()
+        if type_def is typing.Any:
+            # Empty schema accepting any value
+            return result
         if getattr(type_def, '__origin__', None) is typing.Union:
             # Replace Optional[T] by T in type_def
             if len(type_def.__args__) == 2 and type_def.__args__[1] is type(None):
@@ -376,11 +792,166 @@ class RestAPI:
         return result
 
 def init_api(api):
+    @api.schema
+    class AdmissionState:
+        name: str
+        max_concurrency: int
+        max_queue: int
+        active: int
+        waiting: int
+        admitted: int
+        rejected: int
+        timed_out: int
+
     @api.path('/api')
     def get() -> str:
         'Return an OpenAPI 3.0.2 specification for this API'
         return api.open_api
+
+    @api.schema
+    class Readiness:
+        ready: bool
+        draining: bool
+        keys: bool
+        pool: bool
+        database: bool
+
+    @api.path('/health', admission='probe', timeout=1)
+    def get() -> str:
+        'Liveness probe: return "OK" as long as the process serves requests'
+        return 'OK'
+
+    @api.path('/ready', admission='probe', timeout=2)
+    @api.may_abort(503)
+    def get() -> Readiness:
+        '''
+        Readiness probe: the service can receive new requests unless it
+        is stopping, its keys cannot be read, all the database
+        connections of the process are in use or the database cannot
+        be reached. A 503 status is returned when it is not ready.
+        '''
+        result = {
+            'draining': osp.exists(config.drain_file),
+        }
+        try:
+            config.public_key
+            result['keys'] = True
+        except OSError:
+            result['keys'] = False
+        result['pool'] = not get_pool().saturated()
+        result['database'] = False
+        if result['pool']:
+            try:
+                with get_cursor('bv_services', readonly=False) as cur:
+                    cur.execute('SELECT 1')
+                result['database'] = True
+            except Exception:
+                pass
+        result['ready'] = (not result['draining'] and result['keys'] and
+                           result['pool'] and result['database'])
+        return make_response(jsonify(result), 200 if result['ready'] else 503)
+
+    @api.path('/metrics')
+    def get() -> List[AdmissionState]:
+        'Return the state of admission classes in the process serving the request'
+        return [i.state() for i in api.admission_classes.values()]
     
+    @api.schema
+    class BatchRequest:
+        method: str
+        path: str
+        body: typing.Any
+
+    @api.schema
+    class BatchResponse:
+        status: int
+        body: typing.Any
+        committed: bool
+
+    class BatchFailed(Exception):
+        pass
+
+    @api.path('/batch')
+    def post(requests: List[BatchRequest]) -> List[BatchResponse]:
+        '''
+        Execute several operations in a single request and database
+        transaction. Execution stops at the first failed operation, the
+        transaction is rolled back and the remaining operations are
+        returned with a 424 status. committed is false for all the
+        operations when the transaction is rolled back.
+        '''
+        responses = []
+        committed = False
+        try:
+            with transaction():
+                for sub_request in requests:
+                    response = api.dispatch(sub_request['method'],
+                                            sub_request['path'],
+                                            sub_request.get('body'))
+                    responses.append({
+                        'status': response.status_code,
+                        'body': response.get_json(silent=True),
+                    })
+                    if response.status_code >= 400:
+                        raise BatchFailed()
+            committed = True
+        except BatchFailed:
+            pass
+        for sub_request in requests[len(responses):]:
+            responses.append({
+                'status': 424,
+                'body': {'message': 'Not executed because a previous operation failed'},
+            })
+        for response in responses:
+            response['committed'] = committed
+        return responses
+
+    event_hub = EventHub()
+    # Streams are more numerous than pooled connections, they compute
+    # missing roles (e.g. after a granting change) one at a time.
+    stream_roles_lock = threading.Lock()
+
+    def stream_roles(login):
+        with stream_roles_lock:
+            return user_roles(login)
+
+    @api.path('/events', admission='read', timeout=0)
+    @api.require_role('active')
+    @api.may_abort(503)
+    def get() -> str:
+        '''
+        Stream the changes of identities, sessions and grantings as
+        Server-Sent Events. Users that are not identity administrators
+        only receive the events about themselves. The stream ends when
+        the user loses the active role. Each stream holds a server
+        thread, their number per process is limited by the events
+        admission class (EVENT_STREAMS configuration value or
+        BV_EVENT_STREAMS environment variable).
+        '''
+        get_roles()
+        login = g.login
+        admission = api.admission_classes['events']
+        if not admission.try_acquire():
+            response = make_response({'message': f'Too many concurrent event streams ({admission.name})'}, 503)
+            response.headers['Retry-After'] = str(admission.retry_after)
+            return response
+        def stream():
+            events = event_hub.subscribe()
+            try:
+                # Roles are checked again for each event or keepalive,
+                # user_roles is cached and invalidated on changes.
+                yield from event_stream(events, login, partial(stream_roles, login))
+            finally:
+                event_hub.unsubscribe(events)
+        response = Response(stream_with_context(stream()),
+                            mimetype='text/event-stream')
+        # The slot is also released if the stream is never started
+        response.call_on_close(admission.release)
+        response.headers['Cache-Control'] = 'no-cache'
+        # Disable buffering in proxies
+        response.headers['X-Accel-Buffering'] = 'no'
+        return response
+
     @api.flask_app.route('/')
     def swagger_ui():
         return render_template_string(open(osp.join(osp.dirname(__file__), 'swagger-ui.html')).read())
@@ -0,0 +1,116 @@
+'''
+Admission control for RestAPI operations. Each operation belongs to an
+admission class limiting the number of concurrent executions in a
+process. When the limit is reached, a bounded number of requests wait
+for a short time; others are immediately rejected with a 503 response
+so that an overload of expensive operations (e.g. password hashing)
+cannot starve cheap ones.
+'''
+
+import threading
+
+class AdmissionClass:
+    def __init__(self, name, max_concurrency, max_queue=0, queue_timeout=1,
+                 retry_after=1):
+        self.name = name
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.retry_after = retry_after
+        self.condition = threading.Condition()
+        self.active = 0
+        self.waiting = 0
+        self.admitted = 0
+        self.rejected = 0
+        self.timed_out = 0
+
+    def try_acquire(self):
+        '''
+        Acquire an execution slot if one is free, never wait.
+        '''
+        with self.condition:
+            if self.active < self.max_concurrency:
+                self.active += 1
+                self.admitted += 1
+                return True
+            return False
+
+    def acquire(self, timeout=None):
+        '''
+        Acquire an execution slot, waiting in the queue if necessary.
+        Return False if the request is rejected.
+        '''
+        if timeout is None:
+            timeout = self.queue_timeout
+        with self.condition:
+            if self.active < self.max_concurrency:
+                self.active += 1
+                self.admitted += 1
+                return True
+            if self.waiting >= self.max_queue:
+                self.rejected += 1
+                return False
+            self.waiting += 1
+            try:
+                admitted = self.condition.wait_for(lambda: self.active < self.max_concurrency,
+                                                   timeout)
+            finally:
+                self.waiting -= 1
+            if not admitted:
+                self.timed_out += 1
+                return False
+            self.active += 1
+            self.admitted += 1
+            return True
+
+    def release(self):
+        with self.condition:
+            self.active -= 1
+            self.condition.notify()
+
+    def state(self):
+        with self.condition:
+            return {
+                'name': self.name,
+                'max_concurrency': self.max_concurrency,
+                'max_queue': self.max_queue,
+                'active': self.active,
+                'waiting': self.waiting,
+                'admitted': self.admitted,
+                'rejected': self.rejected,
+                'timed_out': self.timed_out,
+            }
+
+
+def default_admission_classes(threads, connections, event_streams):
+    '''
+    Return the parameters of default classes for a process serving
+    requests with the given number of threads and database connections.
+    Up to event_streams /events streams are served by additional
+    threads. They can be modified with the ADMISSION_CLASSES entry of
+    Flask configuration (a dict of dicts of parameters). A queued
+    request holds a thread, therefore active and queued requests of a
+    class leave at least one thread for other classes (otherwise excess
+    requests would wait in the server backlog instead of being
+    rejected), expensive operations use at most half of the threads and
+    a single bulk import runs at a time.
+    The concurrency of classes using the database is bounded by the
+    number of connections.
+    '''
+    available = max(1, threads - 1)
+    read = max(1, min(available, connections))
+    default = max(1, min(threads // 2, connections))
+    expensive = max(1, threads // 4)
+    return {
+        'read': dict(max_concurrency=read, max_queue=available - read, queue_timeout=1),
+        'default': dict(max_concurrency=default, max_queue=max(0, available - default), queue_timeout=1),
+        'expensive': dict(max_concurrency=expensive, max_queue=max(0, threads // 2 - expensive), queue_timeout=2),
+        # Bulk operations running for minutes must not hold the slots
+        # of expensive operations such as logins
+        'import': dict(max_concurrency=1, max_queue=0, queue_timeout=0),
+        # Server-Sent Events streams, each one holds a thread until the
+        # client disconnects
+        'events': dict(max_concurrency=event_streams, max_queue=0, queue_timeout=0),
+        # Health and readiness probes must never wait behind other operations
+        'probe': dict(max_concurrency=threads, max_queue=0, queue_timeout=0),
+    }
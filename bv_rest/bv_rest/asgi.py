@@ -0,0 +1,218 @@
+'''
+ASGI execution mode for RestAPI. Operations defined with async def are
+run in the event loop. All other requests are given to the Flask WSGI
+application in a dedicated thread pool whose size is the number of
+threads used to derive admission classes plus the maximum number of
+/events streams, so that long requests cannot exhaust the default
+executor of the event loop.
+Their body is streamed from the ASGI server. It requires aiopg and
+Flask >= 2.0 (whose request contexts are stored in context variables).
+'''
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import contextvars
+import inspect
+import io
+import sys
+
+from werkzeug.exceptions import HTTPException
+from werkzeug.routing import Map, Rule
+
+import bv_rest
+from bv_rest.async_database import AsyncConnectionPool
+
+class RequestBody(io.RawIOBase):
+    '''
+    WSGI input reading the body of an ASGI request from a thread of the
+    executor.
+    '''
+    def __init__(self, receive, loop):
+        self.receive = receive
+        self.loop = loop
+        self.buffer = b''
+        self.finished = False
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while not self.buffer and not self.finished:
+            message = asyncio.run_coroutine_threadsafe(self.receive(), self.loop).result()
+            if message['type'] == 'http.disconnect':
+                self.finished = True
+            else:
+                self.buffer = message.get('body', b'')
+                self.finished = not message.get('more_body', False)
+        size = min(len(b), len(self.buffer))
+        b[:size] = self.buffer[:size]
+        self.buffer = self.buffer[size:]
+        return size
+
+
+class ASGIApplication:
+    def __init__(self, api, max_connections=10, max_threads=None):
+        self.api = api
+        self.flask_app = api.flask_app
+        if max_threads is None:
+            max_threads = (self.flask_app.config.get('THREADS', bv_rest.config.threads) +
+                           self.flask_app.config.get('EVENT_STREAMS', bv_rest.config.event_streams))
+        self.executor = ThreadPoolExecutor(max_threads, thread_name_prefix='bv_rest_wsgi')
+        self.flask_app.async_db_pool = AsyncConnectionPool(
+            self.flask_app.postgres_user,
+            self.flask_app.postgres_password,
+            primary=bv_rest.config.postgres_host,
+            replicas=bv_rest.config.postgres_replicas,
+            max_connections=max_connections)
+        rules = []
+        for path in api.paths.values():
+            for http_method in ('get', 'post', 'put', 'delete'):
+                function = getattr(path, http_method)
+                if function is not None and inspect.iscoroutinefunction(function):
+                    rules.append(Rule(path.path, endpoint=function,
+                                      methods=[http_method.upper()]))
+        self.url_map = Map(rules)
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self.lifespan(receive, send)
+        elif scope['type'] == 'http':
+            adapter = self.url_map.bind('localhost', path_info=scope['path'])
+            try:
+                function, kwargs = adapter.match(method=scope['method'])
+            except HTTPException:
+                await self.call_wsgi(scope, receive, send)
+            else:
+                await self.call_operation(function, kwargs, scope, receive, send)
+        else:
+            raise ValueError(f'Unsupported ASGI scope type: {scope["type"]}')
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await self.flask_app.async_db_pool.close()
+                self.executor.shutdown(wait=False)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def call_operation(self, function, kwargs, scope, receive, send):
+        environ = self.environ(scope, io.BytesIO(await self.read_body(receive)))
+        with self.flask_app.request_context(environ):
+            response = await function.async_wrapper(**kwargs)
+        await send({
+            'type': 'http.response.start',
+            'status': response.status_code,
+            'headers': [(k.lower().encode('latin1'), v.encode('latin1'))
+                        for k, v in response.headers.items()],
+        })
+        await send({
+            'type': 'http.response.body',
+            'body': response.get_data(),
+        })
+
+    async def call_wsgi(self, scope, receive, send):
+        loop = asyncio.get_event_loop()
+        body = RequestBody(receive, loop)
+        environ = self.environ(scope, io.BufferedReader(body))
+        # The end of the body is signaled by RequestBody
+        environ['wsgi.input_terminated'] = True
+        start = {}
+        def start_response(status, headers, exc_info=None):
+            start['status'] = int(status.split(' ', 1)[0])
+            start['headers'] = [(k.lower().encode('latin1'), v.encode('latin1'))
+                                for k, v in headers]
+        # The response is sent chunk by chunk to support streaming. All
+        # the calls share a context where stream_with_context can keep
+        # the request context between chunks.
+        context = contextvars.copy_context()
+        iterable = await loop.run_in_executor(self.executor, context.run, self.flask_app, environ, start_response)
+        # ASGI servers ignore sent messages after a client disconnection,
+        # endless responses (e.g. /events) are stopped when it happens.
+        disconnected = asyncio.ensure_future(self.wait_disconnect(body))
+        try:
+            iterator = iter(iterable)
+            started = False
+            while True:
+                next_chunk = loop.run_in_executor(self.executor, context.run, next, iterator, None)
+                await asyncio.wait([next_chunk, disconnected],
+                                   return_when=asyncio.FIRST_COMPLETED)
+                # A running generator cannot be closed
+                chunk = await next_chunk
+                if disconnected.done():
+                    break
+                if not started:
+                    await send({
+                        'type': 'http.response.start',
+                        'status': start['status'],
+                        'headers': start['headers'],
+                    })
+                    started = True
+                if chunk is None:
+                    await send({'type': 'http.response.body'})
+                    break
+                if chunk:
+                    await send({
+                        'type': 'http.response.body',
+                        'body': chunk,
+                        'more_body': True,
+                    })
+        finally:
+            disconnected.cancel()
+            if hasattr(iterable, 'close'):
+                await loop.run_in_executor(self.executor, context.run, iterable.close)
+
+    async def wait_disconnect(self, body):
+        # The application has read the body it needs, the rest is ignored
+        body.finished = True
+        while True:
+            message = await body.receive()
+            if message['type'] == 'http.disconnect':
+                return
+
+    async def read_body(self, receive):
+        body = []
+        while True:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                break
+            body.append(message.get('body', b''))
+            if not message.get('more_body', False):
+                break
+        return b''.join(body)
+
+    def environ(self, scope, input):
+        server = scope.get('server') or ('localhost', 80)
+        environ = {
+            'REQUEST_METHOD': scope['method'],
+            'SCRIPT_NAME': scope.get('root_path', '').encode('utf8').decode('latin1'),
+            'PATH_INFO': scope['path'].encode('utf8').decode('latin1'),
+            'QUERY_STRING': scope.get('query_string', b'').decode('latin1'),
+            'SERVER_NAME': server[0],
+            'SERVER_PORT': str(server[1] or 80),
+            'SERVER_PROTOCOL': 'HTTP/%s' % scope.get('http_version', '1.1'),
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': scope.get('scheme', 'http'),
+            'wsgi.input': input,
+            'wsgi.errors': sys.stderr,
+            'wsgi.multithread': True,
+            'wsgi.multiprocess': True,
+            'wsgi.run_once': False,
+        }
+        if scope.get('client'):
+            environ['REMOTE_ADDR'] = scope['client'][0]
+        for name, value in scope.get('headers', []):
+            name = name.decode('latin1')
+            value = value.decode('latin1')
+            if name == 'content-length':
+                key = 'CONTENT_LENGTH'
+            elif name == 'content-type':
+                key = 'CONTENT_TYPE'
+            else:
+                key = 'HTTP_' + name.upper().replace('-', '_')
+            if key in environ:
+                value = environ[key] + ',' + value
+            environ[key] = value
+        return environ
@@ -0,0 +1,113 @@
+'''
+Asynchronous counterpart of bv_rest.database for operations defined
+with async def in ASGI mode. It requires aiopg.
+'''
+
+import asyncio
+import itertools
+
+import aiopg
+from flask import current_app
+import psycopg2.extras
+
+from bv_rest.database import is_readonly, statement_timeout
+
+class AsyncConnectionPool:
+    '''
+    One aiopg pool per server and database. Read-only cursors are
+    distributed between replicas in a round robin way.
+    '''
+    def __init__(self, postgres_user, postgres_password,
+                 primary='bv_postgres', replicas=(), max_connections=10):
+        self.postgres_user = postgres_user
+        self.postgres_password = postgres_password
+        self.primary = primary
+        self.replicas = list(replicas)
+        self.max_connections = max_connections
+        self.replica_cycle = itertools.cycle(self.replicas)
+        self.pools = {}
+
+    def select_host(self, readonly):
+        if readonly and self.replicas:
+            return next(self.replica_cycle)
+        return self.primary
+
+    async def get_pool(self, host, database):
+        key = (host, database)
+        future = self.pools.get(key)
+        if future is None:
+            host_name, _, port = host.partition(':')
+            future = asyncio.ensure_future(aiopg.create_pool(
+                host=host_name,
+                port=port or None,
+                dbname=database,
+                user=self.postgres_user,
+                password=self.postgres_password,
+                maxsize=self.max_connections))
+            self.pools[key] = future
+        try:
+            return await future
+        except Exception:
+            if self.pools.get(key) is future:
+                del self.pools[key]
+            raise
+
+    async def close(self):
+        pools, self.pools = self.pools, {}
+        for future in pools.values():
+            try:
+                pool = await future
+            except Exception:
+                continue
+            pool.close()
+            await pool.wait_closed()
+
+
+class AsyncDatabaseCursor:
+    def __init__(self, database, as_dict=False, readonly=None):
+        self.database = database
+        self.as_dict = as_dict
+        self.readonly = readonly
+
+    async def __aenter__(self):
+        timeout = statement_timeout()
+        db_pool = current_app.async_db_pool
+        host = db_pool.select_host(is_readonly(self.readonly))
+        self.pool = await db_pool.get_pool(host, self.database)
+        self.connection = await self.pool.acquire()
+        try:
+            if self.as_dict:
+                self.cursor = await self.connection.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
+            else:
+                self.cursor = await self.connection.cursor()
+            # aiopg connections are in autocommit mode. The transaction
+            # is started and the timeout set in a single round trip.
+            if timeout is None:
+                await self.cursor.execute('BEGIN')
+            else:
+                await self.cursor.execute('BEGIN; SET LOCAL statement_timeout = %s', [timeout])
+        except Exception:
+            await self.pool.release(self.connection)
+            raise
+        return self.cursor
+
+    async def __aexit__(self, x, y, z):
+        try:
+            if x is None:
+                await self.cursor.execute('COMMIT')
+            else:
+                await self.cursor.execute('ROLLBACK')
+        finally:
+            self.cursor.close()
+            await self.pool.release(self.connection)
+            self.pool = self.connection = self.cursor = None
+
+
+def get_cursor(database, as_dict=False, readonly=None):
+    '''
+    Asynchronous version of bv_rest.database.get_cursor() to be used
+    with "async with". Cursor methods must be awaited.
+    '''
+    return AsyncDatabaseCursor(database,
+                               as_dict=as_dict,
+                               readonly=readonly)
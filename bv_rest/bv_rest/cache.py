@@ -0,0 +1,132 @@
+'''
+Per process cache of operation results. Entries are invalidated by
+NOTIFY events sent by table triggers so that all worker processes stay
+consistent with the database.
+'''
+
+from collections import OrderedDict
+from contextlib import nullcontext
+from functools import wraps
+import inspect
+import threading
+import time
+
+from flask import current_app, g, has_app_context
+
+from bv_rest.database import on_primary
+
+class Cache:
+    '''
+    A bounded LRU cache with optional time to live. Entries computed
+    before a call to clear() are not stored by set().
+    '''
+    missing = object()
+
+    def __init__(self, maxsize=1024, ttl=None):
+        self.lock = threading.Lock()
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.generation = 0
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return self.missing
+            expiration, value = entry
+            if expiration is not None and expiration < time.monotonic():
+                del self.entries[key]
+                return self.missing
+            self.entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, generation):
+        with self.lock:
+            if generation != self.generation:
+                return
+            expiration = (None if self.ttl is None
+                          else time.monotonic() + self.ttl)
+            self.entries[key] = (expiration, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    def pop(self, key):
+        with self.lock:
+            self.generation += 1
+            self.entries.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.generation += 1
+            self.entries.clear()
+
+
+def cached(ttl=None, key=None, invalidate_on=(), maxsize=1024,
+           database='bv_services'):
+    '''
+    Decorator caching the result of a function. key is a function
+    returning the cache key from the function parameters (by default
+    all the parameters are used). The whole cache is cleared when one
+    of the tables in invalidate_on is modified. Results are shared
+    between calls and must not be modified.
+    '''
+    tables = set(invalidate_on)
+    def decorator(function):
+        cache = Cache(maxsize=maxsize, ttl=ttl)
+
+        def invalidate(table):
+            if table is None or table in tables:
+                cache.clear()
+
+        def lookup(args, kwargs):
+            listener = None
+            if tables:
+                listener = current_app.db_listener
+                listener.listen(database, 'table_changed', invalidate)
+            if key is None:
+                k = (args, tuple(sorted(kwargs.items())))
+            else:
+                k = key(*args, **kwargs)
+            return listener, k, cache.get(k), cache.generation
+
+        def store(listener, k, value, generation):
+            # Without an active LISTEN, changes could be missed
+            if listener is None or listener.is_listening(database, 'table_changed'):
+                cache.set(k, value, generation)
+
+        # Values that are invalidated by notifications from the primary
+        # are not read from a replica that may be late.
+        compute_context = (on_primary if tables else nullcontext)
+
+        def in_transaction():
+            # In a shared transaction, cached values would not contain its
+            # uncommitted changes and computed values may be rolled back.
+            return has_app_context() and g.get('db_transaction') is not None
+
+        if inspect.iscoroutinefunction(function):
+            @wraps(function)
+            async def wrapper(*args, **kwargs):
+                if in_transaction():
+                    return await function(*args, **kwargs)
+                listener, k, value, generation = lookup(args, kwargs)
+                if value is cache.missing:
+                    with compute_context():
+                        value = await function(*args, **kwargs)
+                    store(listener, k, value, generation)
+                return value
+        else:
+            @wraps(function)
+            def wrapper(*args, **kwargs):
+                if in_transaction():
+                    return function(*args, **kwargs)
+                listener, k, value, generation = lookup(args, kwargs)
+                if value is cache.missing:
+                    with compute_context():
+                        value = function(*args, **kwargs)
+                    store(listener, k, value, generation)
+                return value
+        wrapper.cache = cache
+        return wrapper
+    return decorator
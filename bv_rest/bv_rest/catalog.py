@@ -0,0 +1,285 @@
+'''
+Introspection of PostgreSQL databases using pg_catalog. Results are
+cached per process and invalidated by the ddl_changed event trigger
+that notifies listeners on every schema change.
+'''
+
+from collections import OrderedDict
+from functools import wraps
+import threading
+
+from flask import current_app
+
+from bv_rest.cache import Cache, cached
+from bv_rest.database import get_cursor, on_primary
+
+# Each listened database needs a connection per worker process,
+# therefore only the most recently used databases are cached.
+max_databases = 8
+
+_caches = []
+_listened = OrderedDict()
+_lock = threading.Lock()
+
+def ddl_changed(database):
+    for cache in _caches:
+        if database is None:
+            cache.clear()
+        else:
+            cache.pop(database)
+
+
+def listen(database):
+    '''
+    Listen to schema changes of a database. If more than max_databases
+    are listened, the least recently used one is removed from caches
+    and its LISTEN connection is closed.
+    '''
+    listener = current_app.db_listener
+    evicted = None
+    with _lock:
+        if database in _listened:
+            _listened.move_to_end(database)
+        else:
+            _listened[database] = True
+            if len(_listened) > max_databases:
+                evicted = _listened.popitem(last=False)[0]
+    if evicted is not None:
+        listener.unlisten(evicted, 'ddl_changed', ddl_changed)
+        ddl_changed(evicted)
+    listener.listen(database, 'ddl_changed', ddl_changed)
+    return listener
+
+
+def _has_ddl_trigger(cur):
+    cur.execute("SELECT count(*) FROM pg_event_trigger WHERE evtname = 'ddl_changed' AND evtenabled != 'D'")
+    return cur.fetchone()[0] > 0
+
+
+def per_database(ttl=None):
+    '''
+    Decorator caching the result of a function taking a database name
+    until the schema of this database changes. Databases without the
+    ddl_changed event trigger are never cached.
+    '''
+    def decorator(function):
+        cache = Cache(maxsize=max_databases, ttl=ttl)
+        _caches.append(cache)
+
+        @wraps(function)
+        def wrapper(database):
+            result = cache.get(database)
+            if result is not cache.missing:
+                return result
+            listener = listen(database)
+            generation = cache.generation
+            with on_primary():
+                with get_cursor(database) as cur:
+                    cacheable = _has_ddl_trigger(cur)
+                result = function(database)
+            if cacheable and listener.is_listening(database, 'ddl_changed'):
+                cache.set(database, result, generation)
+            return result
+        wrapper.cache = cache
+        return wrapper
+    return decorator
+
+
+@cached(ttl=60)
+def databases():
+    '''
+    Return the names of all non template databases. CREATE DATABASE
+    does not fire event triggers, therefore this list is only cached
+    for a short time.
+    '''
+    with get_cursor('bv_services') as cur:
+        sql = "SELECT datname FROM pg_database WHERE datistemplate IS FALSE AND datname != 'postgres' ORDER BY datname"
+        cur.execute(sql)
+        return tuple(row[0] for row in cur)
+
+
+def _user_relations(cur, relkinds):
+    sql = '''SELECT c.oid, c.relkind, c.oid::regclass::text
+             FROM pg_class c
+             JOIN pg_namespace n ON n.oid = c.relnamespace
+             WHERE c.relkind = ANY(%s)
+               AND n.nspname NOT IN ('pg_catalog', 'information_schema')
+               AND n.nspname NOT LIKE 'pg\\_toast%%'
+               AND NOT EXISTS (SELECT 1 FROM pg_depend d
+                               WHERE d.classid = 'pg_class'::regclass
+                                 AND d.objid = c.oid AND d.deptype IN ('e', 'i'))
+             ORDER BY c.oid'''
+    cur.execute(sql, [list(relkinds)])
+    return cur.fetchall()
+
+
+@per_database()
+def schema_ddl(database):
+    '''
+    Return the SQL statements creating the schema of a database
+    (similar to pg_dump -s).
+    '''
+    statements = []
+    with get_cursor(database) as cur:
+        sql = '''SELECT quote_ident(nspname) FROM pg_namespace
+                 WHERE nspname NOT IN ('public', 'pg_catalog', 'information_schema')
+                   AND nspname NOT LIKE 'pg\\_%'
+                 ORDER BY nspname'''
+        cur.execute(sql)
+        statements.extend(f'CREATE SCHEMA {row[0]};' for row in cur.fetchall())
+
+        sql = '''SELECT quote_ident(e.extname), quote_ident(n.nspname)
+                 FROM pg_extension e
+                 JOIN pg_namespace n ON n.oid = e.extnamespace
+                 WHERE e.extname != 'plpgsql'
+                 ORDER BY e.extname'''
+        cur.execute(sql)
+        statements.extend(f'CREATE EXTENSION IF NOT EXISTS {row[0]} WITH SCHEMA {row[1]};'
+                          for row in cur.fetchall())
+
+        sql = '''SELECT c.oid::regclass::text, format_type(s.seqtypid, NULL),
+                        s.seqincrement, s.seqmin, s.seqmax, s.seqstart
+                 FROM pg_sequence s
+                 JOIN pg_class c ON c.oid = s.seqrelid
+                 WHERE s.seqrelid = ANY(%s)
+                 ORDER BY c.oid'''
+        cur.execute(sql, [[row[0] for row in _user_relations(cur, 'S')]])
+        statements.extend(f'CREATE SEQUENCE {name} AS {type} INCREMENT BY {increment} MINVALUE {minimum} MAXVALUE {maximum} START WITH {start};'
+                          for name, type, increment, minimum, maximum, start in cur.fetchall())
+
+        sql = '''SELECT pg_get_functiondef(p.oid)
+                 FROM pg_proc p
+                 JOIN pg_namespace n ON n.oid = p.pronamespace
+                 WHERE n.nspname NOT IN ('pg_catalog', 'information_schema')
+                   AND p.prokind IN ('f', 'p')
+                   AND NOT EXISTS (SELECT 1 FROM pg_depend d
+                                   WHERE d.classid = 'pg_proc'::regclass
+                                     AND d.objid = p.oid AND d.deptype = 'e')
+                 ORDER BY p.oid'''
+        cur.execute(sql)
+        statements.extend(f'{row[0].strip()};' for row in cur.fetchall())
+
+        relations = _user_relations(cur, 'rpvm')
+        tables = [(oid, name) for oid, relkind, name in relations if relkind in 'rp']
+        table_oids = [i[0] for i in tables]
+        sql = '''SELECT a.attrelid, quote_ident(a.attname),
+                        format_type(a.atttypid, a.atttypmod),
+                        pg_get_expr(ad.adbin, ad.adrelid), a.attnotnull,
+                        a.attidentity
+                 FROM pg_attribute a
+                 LEFT JOIN pg_attrdef ad ON ad.adrelid = a.attrelid AND ad.adnum = a.attnum
+                 WHERE a.attrelid = ANY(%s) AND a.attnum > 0 AND NOT a.attisdropped
+                 ORDER BY a.attrelid, a.attnum'''
+        cur.execute(sql, [table_oids])
+        columns = {}
+        for oid, name, type, default, not_null, identity in cur.fetchall():
+            column = f'{name} {type}'
+            if identity:
+                column += ' GENERATED %s AS IDENTITY' % ('ALWAYS' if identity == 'a' else 'BY DEFAULT')
+            elif default is not None:
+                column += f' DEFAULT {default}'
+            if not_null:
+                column += ' NOT NULL'
+            columns.setdefault(oid, []).append(column)
+        sql = '''SELECT conrelid, quote_ident(conname), contype,
+                        pg_get_constraintdef(oid)
+                 FROM pg_constraint
+                 WHERE conrelid = ANY(%s) AND contype IN ('p', 'u', 'c', 'x', 'f')
+                 ORDER BY conrelid, contype, conname'''
+        cur.execute(sql, [table_oids])
+        foreign_keys = []
+        for oid, name, type, definition in cur.fetchall():
+            if type == 'f':
+                foreign_keys.append((oid, name, definition))
+            else:
+                columns.setdefault(oid, []).append(f'CONSTRAINT {name} {definition}')
+        for oid, name in tables:
+            items = ',\n    '.join(columns.get(oid, []))
+            statements.append(f'CREATE TABLE {name}\n(\n    {items}\n);')
+
+        cur.execute('SELECT oid, pg_get_viewdef(oid, true) FROM pg_class WHERE oid = ANY(%s)',
+                    [[oid for oid, relkind, name in relations if relkind in 'vm']])
+        views = dict(cur.fetchall())
+        for oid, relkind, name in relations:
+            if relkind in 'vm':
+                kind = ('MATERIALIZED VIEW' if relkind == 'm' else 'VIEW')
+                statements.append(f'CREATE {kind} {name} AS\n{views[oid].rstrip(";")};')
+
+        names = dict(tables)
+        statements.extend(f'ALTER TABLE {names[oid]} ADD CONSTRAINT {name} {definition};'
+                          for oid, name, definition in foreign_keys)
+
+        sql = '''SELECT pg_get_indexdef(i.indexrelid)
+                 FROM pg_index i
+                 WHERE i.indrelid = ANY(%s)
+                   AND NOT EXISTS (SELECT 1 FROM pg_constraint c
+                                   WHERE c.conrelid = i.indrelid
+                                     AND c.conindid = i.indexrelid)
+                 ORDER BY i.indrelid, i.indexrelid'''
+        cur.execute(sql, [[oid for oid, relkind, name in relations]])
+        statements.extend(f'{row[0]};' for row in cur.fetchall())
+
+        sql = '''SELECT pg_get_triggerdef(oid)
+                 FROM pg_trigger
+                 WHERE tgrelid = ANY(%s) AND NOT tgisinternal
+                 ORDER BY tgrelid, tgname'''
+        cur.execute(sql, [[oid for oid, relkind, name in relations]])
+        statements.extend(f'{row[0]};' for row in cur.fetchall())
+
+        sql = '''SELECT quote_ident(evtname), evtevent, evtfoid::regproc
+                 FROM pg_event_trigger
+                 ORDER BY evtname'''
+        cur.execute(sql)
+        statements.extend(f'CREATE EVENT TRIGGER {name} ON {event} EXECUTE PROCEDURE {function}();'
+                          for name, event, function in cur.fetchall())
+    return '\n\n'.join(statements)
+
+
+# Row estimates are updated by ANALYZE without any schema change,
+# therefore they are only cached for a short time.
+@per_database(ttl=60)
+def tables(database):
+    '''
+    Return the tables of a database with their columns, indexes and an
+    estimation of their number of rows.
+    '''
+    with get_cursor(database, as_dict=True) as cur:
+        sql = '''SELECT c.oid, c.oid::regclass::text AS name,
+                        greatest(c.reltuples, 0)::bigint AS row_estimate
+                 FROM pg_class c
+                 JOIN pg_namespace n ON n.oid = c.relnamespace
+                 WHERE c.relkind IN ('r', 'p')
+                   AND n.nspname NOT IN ('pg_catalog', 'information_schema')
+                   AND n.nspname NOT LIKE 'pg\\_toast%'
+                 ORDER BY 2'''
+        cur.execute(sql)
+        result = cur.fetchall()
+        oids = [table['oid'] for table in result]
+        sql = '''SELECT a.attrelid, a.attname AS name,
+                        format_type(a.atttypid, a.atttypmod) AS type,
+                        NOT a.attnotnull AS nullable,
+                        pg_get_expr(ad.adbin, ad.adrelid) AS default
+                 FROM pg_attribute a
+                 LEFT JOIN pg_attrdef ad ON ad.adrelid = a.attrelid AND ad.adnum = a.attnum
+                 WHERE a.attrelid = ANY(%s) AND a.attnum > 0 AND NOT a.attisdropped
+                 ORDER BY a.attrelid, a.attnum'''
+        cur.execute(sql, [oids])
+        columns = {}
+        for column in cur.fetchall():
+            columns.setdefault(column.pop('attrelid'), []).append(column)
+        sql = '''SELECT i.indrelid, c.relname AS name,
+                        i.indisprimary AS primary, i.indisunique AS unique,
+                        pg_get_indexdef(i.indexrelid) AS definition
+                 FROM pg_index i
+                 JOIN pg_class c ON c.oid = i.indexrelid
+                 WHERE i.indrelid = ANY(%s)
+                 ORDER BY i.indrelid, c.relname'''
+        cur.execute(sql, [oids])
+        indexes = {}
+        for index in cur.fetchall():
+            indexes.setdefault(index.pop('indrelid'), []).append(index)
+    for table in result:
+        oid = table.pop('oid')
+        table['columns'] = columns.get(oid, [])
+        table['indexes'] = indexes.get(oid, [])
+    return result
@@ -1,57 +1,185 @@
 import collections
+from contextlib import contextmanager
+import os
+import select
 import threading
 import time
 
-from flask import current_app
+from flask import abort, current_app, g, has_app_context, has_request_context, request
 import psycopg2
+import psycopg2.extensions
 import psycopg2.extras
+import psycopg2.sql
 
 import bv_rest
 
+def connect(host, database, user, password, connect_timeout=None):
+    '''
+    Open a connection to a PostgreSQL server given as "host" or
+    "host:port".
+    '''
+    host, _, port = host.partition(':')
+    return psycopg2.connect(host=host,
+                            port=port or None,
+                            dbname=database,
+                            user=user,
+                            password=password,
+                            connect_timeout=connect_timeout)
+
+
 class ConnectionPool:
+    '''
+    Pool of connections to a primary server and optional read replicas.
+    Read-only connections are balanced between replicas using either
+    'round_robin' or 'least_connections'. A replica whose replication
+    lag is greater than max_replication_lag seconds is not used until
+    its next lag check. Without usable replica, the primary is used.
+    '''
     class ConnectionRecord:
-        def __init__(self, database, creation_time, last_used, connection):
+        def __init__(self, host, database, creation_time, last_used, connection):
+            self.host = host
             self.database = database
             self.creation_time = creation_time
             self.last_used = last_used
             self.connection = connection
 
-    def __init__(self, max_connections=6):
+    def __init__(self, primary='bv_postgres', replicas=(),
+                 balancing='round_robin', max_replication_lag=5,
+                 lag_check_interval=1, max_connections=6,
+                 connect_timeout=2):
+        if balancing not in ('round_robin', 'least_connections'):
+            raise ValueError(f'Invalid balancing method: {balancing}')
         self.lock = threading.RLock()
+        self.primary = primary
+        self.replicas = list(replicas)
+        self.balancing = balancing
+        self.max_replication_lag = max_replication_lag
+        self.lag_check_interval = lag_check_interval
         self.max_connections = max_connections
+        self.connect_timeout = connect_timeout
+        # Number of connections being opened outside of the lock
+        self.connecting = 0
         self.free = collections.deque()
         self.free_per_database = {}
         self.in_use = collections.deque()
+        self.next_replica = 0
+        # Replica host -> (check time, usable)
+        self.replica_state = {}
+
+    def usable_replicas(self):
+        now = time.time()
+        result = []
+        for host in self.replicas:
+            check_time, usable = self.replica_state.get(host, (None, True))
+            if usable or now - check_time > self.lag_check_interval:
+                result.append(host)
+        return result
+
+    def select_host(self, readonly):
+        if not readonly:
+            return self.primary
+        replicas = self.usable_replicas()
+        if not replicas:
+            return self.primary
+        if self.balancing == 'least_connections':
+            in_use = collections.Counter(record.host for record in self.in_use)
+            return min(replicas, key=lambda host: in_use[host])
+        self.next_replica = (self.next_replica + 1) % len(replicas)
+        return replicas[self.next_replica]
 
-    def get_connection(self, database):
+    def check_replica(self, host, connection):
+        '''
+        Check the replication lag of a replica if it was not done
+        recently. Return False if the replica must not be used.
+        '''
+        check_time, usable = self.replica_state.get(host, (0, True))
+        if time.time() - check_time < self.lag_check_interval:
+            return usable
+        with connection.cursor() as cur:
+            cur.execute('''SELECT CASE WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+                                    ELSE coalesce(extract(epoch FROM now() - pg_last_xact_replay_timestamp()), 0)
+                               END''')
+            lag = cur.fetchone()[0]
+        connection.rollback()
+        usable = (lag <= self.max_replication_lag)
+        self.replica_state[host] = (time.time(), usable)
+        return usable
+
+    def get_connection(self, database, readonly=False):
+        while True:
+            with self.lock:
+                host = self.select_host(readonly)
+            try:
+                connection = self.get_host_connection(host, database)
+            except psycopg2.OperationalError:
+                if host == self.primary:
+                    raise
+                with self.lock:
+                    self.replica_state[host] = (time.time(), False)
+                continue
+            if host == self.primary:
+                return connection
+            try:
+                usable = self.check_replica(host, connection)
+            except psycopg2.Error:
+                self.replica_state[host] = (time.time(), False)
+                self.free_connection(connection, discard=True)
+                continue
+            if usable:
+                return connection
+            self.free_connection(connection)
+
+    def get_host_connection(self, host, database):
         with self.lock:
-            free = self.free_per_database.get(database)
+            free = self.free_per_database.get((host, database))
             if free:
                 record = free.popleft()
                 record.last_used = time.time()
                 self.free.remove(record)
                 self.in_use.append(record)
                 return record.connection
-            elif self.free:
-                record = self.free.popleft()
-                record.last_used = time.time()
-                self.free_per_database[record.database].remove(record)
-                self.in_use.append(record)
-                return record.connection
-            if len(self.in_use) == self.max_connections:
+            if len(self.in_use) + self.connecting >= self.max_connections:
                 raise RuntimeError('All database connections are in use')
-            connection =  psycopg2.connect(host='bv_postgres',
-                                           dbname=database,
-                                           user=current_app.postgres_user,
-                                           password=current_app.postgres_password)
-            record = self.ConnectionRecord(database=database,
-                                           creation_time=time.time(),
-                                           last_used=time.time(),
-                                           connection=connection)
+            if len(self.in_use) + self.connecting + len(self.free) >= self.max_connections:
+                # Close the least recently used connection to another
+                # database since a connection cannot change database.
+                record = self.free.popleft()
+                self.free_per_database[(record.host, record.database)].remove(record)
+                record.connection.close()
+            # The slot is reserved and the connection is opened without
+            # the lock to not block other threads if the server is slow
+            # or unreachable.
+            self.connecting += 1
+        try:
+            connection = connect(host, database,
+                                 current_app.postgres_user,
+                                 current_app.postgres_password,
+                                 connect_timeout=self.connect_timeout)
+        finally:
+            with self.lock:
+                self.connecting -= 1
+        record = self.ConnectionRecord(host=host,
+                                       database=database,
+                                       creation_time=time.time(),
+                                       last_used=time.time(),
+                                       connection=connection)
+        with self.lock:
             self.in_use.append(record)
-            return record.connection
+        return record.connection
+
+    def saturated(self):
+        with self.lock:
+            return len(self.in_use) + self.connecting >= self.max_connections
 
-    def free_connection(self, connection):
+    def close(self):
+        with self.lock:
+            for record in list(self.free) + list(self.in_use):
+                record.connection.close()
+            self.free.clear()
+            self.free_per_database.clear()
+            self.in_use.clear()
+
+    def free_connection(self, connection, discard=False):
         with self.lock:
             for record in self.in_use:
                 if record.connection == connection:
@@ -60,40 +188,329 @@ class ConnectionPool:
                 record = None
             if record is not None:
                 self.in_use.remove(record)
+                if discard:
+                    record.connection.close()
+                    return
                 record.last_used = time.time()
                 self.free.append(record)
-                self.free_per_database.setdefault(record.database, collections.deque()).append(record)
+                self.free_per_database.setdefault((record.host, record.database), collections.deque()).append(record)
+
+
+class Listener:
+    '''
+    Dispatch PostgreSQL notifications to callbacks in a background
+    thread. There is one LISTEN connection per database. Each time a
+    connection is (re)established, callbacks are called with a None
+    payload because notifications may have been missed.
+    '''
+    def __init__(self, postgres_user, postgres_password, host='bv_postgres'):
+        self.postgres_user = postgres_user
+        self.postgres_password = postgres_password
+        self.host = host
+        self.lock = threading.Lock()
+        self.callbacks = {}
+        self.listening = set()
+        self.thread = None
+        self.pid = None
+        self.wakeup = None
+
+    def listen(self, database, channel, callback):
+        with self.lock:
+            callbacks = self.callbacks.setdefault((database, channel), [])
+            started = (self.pid == os.getpid())
+            if callback in callbacks and started:
+                return
+            if callback not in callbacks:
+                callbacks.append(callback)
+            if started:
+                os.write(self.wakeup[1], b'.')
+                return
+            # The thread is started lazily and restarted in a forked
+            # process because threads and connections are not inherited.
+            self.pid = os.getpid()
+            self.listening = set()
+            self.wakeup = os.pipe()
+            self.thread = threading.Thread(target=self.run, daemon=True)
+            self.thread.start()
+
+    def unlisten(self, database, channel, callback):
+        '''
+        Remove a callback. When a database has no more callbacks, its
+        LISTEN connection is closed.
+        '''
+        with self.lock:
+            callbacks = self.callbacks.get((database, channel), [])
+            if callback not in callbacks:
+                return
+            callbacks.remove(callback)
+            if not callbacks:
+                del self.callbacks[(database, channel)]
+                if self.pid == os.getpid():
+                    os.write(self.wakeup[1], b'.')
+
+    def is_listening(self, database, channel):
+        return (database, channel) in self.listening
+
+    def dispatch(self, database, channel, payload):
+        with self.lock:
+            callbacks = list(self.callbacks.get((database, channel), ()))
+        for callback in callbacks:
+            callback(payload)
+
+    def connect(self, database):
+        connection = connect(self.host, database,
+                             self.postgres_user, self.postgres_password,
+                             connect_timeout=2)
+        connection.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+        return connection
+
+    def run(self):
+        connections = {}
+        while True:
+            with self.lock:
+                wanted = list(self.callbacks)
+            for database, channel in self.listening.difference(wanted):
+                self.listening = self.listening.difference([(database, channel)])
+                connection = connections.get(database)
+                if connection is None:
+                    continue
+                if any(i[0] == database for i in wanted):
+                    try:
+                        with connection.cursor() as cur:
+                            cur.execute(psycopg2.sql.SQL('UNLISTEN {}').format(psycopg2.sql.Identifier(channel)))
+                    except psycopg2.Error:
+                        pass
+                else:
+                    del connections[database]
+                    connection.close()
+            for database, channel in wanted:
+                if (database, channel) in self.listening:
+                    continue
+                try:
+                    connection = connections.get(database)
+                    if connection is None:
+                        connection = connections[database] = self.connect(database)
+                    with connection.cursor() as cur:
+                        cur.execute(psycopg2.sql.SQL('LISTEN {}').format(psycopg2.sql.Identifier(channel)))
+                except psycopg2.Error:
+                    connections.pop(database, None)
+                    time.sleep(1)
+                    continue
+                self.listening.add((database, channel))
+                self.dispatch(database, channel, None)
+            readable = select.select([self.wakeup[0]] + list(connections.values()), [], [], 5)[0]
+            if self.wakeup[0] in readable:
+                os.read(self.wakeup[0], 4096)
+            for database, connection in list(connections.items()):
+                if connection not in readable:
+                    continue
+                try:
+                    connection.poll()
+                except psycopg2.Error:
+                    del connections[database]
+                    lost = [i for i in self.listening if i[0] == database]
+                    self.listening = self.listening.difference(lost)
+                    for channel in lost:
+                        self.dispatch(database, channel[1], None)
+                    continue
+                while connection.notifies:
+                    notify = connection.notifies.pop(0)
+                    self.dispatch(database, notify.channel, notify.payload)
+
+
+def is_readonly(readonly=None):
+    '''
+    Resolve the default value of the readonly parameter of get_db() and
+    get_cursor(): GET requests are read-only unless on_primary() is used.
+    '''
+    if readonly is not None:
+        return readonly
+    if has_app_context() and g.get('db_on_primary', False):
+        return False
+    return has_request_context() and request.method == 'GET'
+
+
+@contextmanager
+def on_primary():
+    '''
+    Context manager sending default cursors to the primary server. It
+    is used to fill caches that are invalidated by notifications from
+    the primary because replicas may not have replayed the changes yet.
+    '''
+    if not has_app_context():
+        yield
+        return
+    previous = g.get('db_on_primary', False)
+    g.db_on_primary = True
+    try:
+        yield
+    finally:
+        g.db_on_primary = previous
+
+
+def statement_timeout():
+    '''
+    Return the time left before the deadline of the current request in
+    milliseconds or None if there is no deadline. Abort with a 504
+    error if the deadline is passed.
+    '''
+    if not has_app_context():
+        return None
+    deadline = g.get('deadline')
+    if deadline is None:
+        return None
+    remaining = deadline - time.monotonic()
+    if remaining <= 0:
+        abort(504, 'Operation deadline exceeded')
+    return max(1, int(remaining * 1000))
+
+
+def set_statement_timeout(connection, timeout):
+    if timeout is not None:
+        # The server cancels queries running after the deadline
+        with connection.cursor() as cur:
+            cur.execute('SET LOCAL statement_timeout = %s', [timeout])
+
+
+class TimeoutCursorMixin:
+    '''
+    Cursor sending a pending statement timeout with its first query, in
+    the same round trip as the query.
+    '''
+    statement_timeout = None
+
+    def apply_statement_timeout(self):
+        timeout, self.statement_timeout = self.statement_timeout, None
+        set_statement_timeout(self.connection, timeout)
+
+    def execute(self, query, vars=None):
+        timeout, self.statement_timeout = self.statement_timeout, None
+        if timeout is not None:
+            # Results are the ones of the last statement
+            query = b'SET LOCAL statement_timeout = %d; %s' % (timeout, self.mogrify(query, vars))
+            vars = None
+        return super().execute(query, vars)
+
+    def executemany(self, query, vars_list):
+        self.apply_statement_timeout()
+        return super().executemany(query, vars_list)
+
+    def callproc(self, procname, parameters=None):
+        self.apply_statement_timeout()
+        return super().callproc(procname, parameters)
+
+    def copy_expert(self, sql, file, size=8192):
+        self.apply_statement_timeout()
+        return super().copy_expert(sql, file, size)
+
+    def copy_from(self, *args, **kwargs):
+        self.apply_statement_timeout()
+        return super().copy_from(*args, **kwargs)
+
+    def copy_to(self, *args, **kwargs):
+        self.apply_statement_timeout()
+        return super().copy_to(*args, **kwargs)
+
+
+class TimeoutCursor(TimeoutCursorMixin, psycopg2.extensions.cursor):
+    pass
+
+
+class TimeoutDictCursor(TimeoutCursorMixin, psycopg2.extras.RealDictCursor):
+    pass
 
 
 class WithDatabaseConnection:
-    def __init__(self, database):
+    '''
+    Context manager giving a pooled connection. The statement timeout of
+    the request is set on the connection unless defer_timeout is true.
+    In that case, it is stored in the timeout attribute and must be sent
+    by the caller (see TimeoutCursorMixin).
+    '''
+    def __init__(self, database, readonly=None, defer_timeout=False):
         self.database = database
+        self.readonly = readonly
+        self.defer_timeout = defer_timeout
+        self.shared = False
+        self.timeout = None
     
     def __enter__(self):
-        self.connection = current_app.db_pool.get_connection(self.database)
+        timeout = statement_timeout()
+        if self.defer_timeout:
+            self.timeout, timeout = timeout, None
+        connections = g.get('db_transaction') if has_app_context() else None
+        self.shared = (connections is not None)
+        if self.shared:
+            connection = connections.get(self.database)
+            if connection is None:
+                connection = get_pool().get_connection(self.database)
+                connections[self.database] = connection
+            set_statement_timeout(connection, timeout)
+            return connection
+        self.connection = get_pool().get_connection(self.database,
+                                                    readonly=is_readonly(self.readonly))
+        try:
+            set_statement_timeout(self.connection, timeout)
+        except Exception:
+            self.connection.rollback()
+            get_pool().free_connection(self.connection)
+            raise
         return self.connection
 
     def __exit__(self, x, y, z):
+        if self.shared:
+            # Committed or rolled back at the end of transaction()
+            return
         if x is None:
             self.connection.commit()
         else:
             self.connection.rollback()
-        current_app.db_pool.free_connection(self.connection)
+        get_pool().free_connection(self.connection)
         self.connection = None
 
 
+@contextmanager
+def transaction():
+    '''
+    Context manager sharing one connection per database between all
+    get_db() and get_cursor() calls of the current request. Everything
+    is done on the primary server in a single transaction per database
+    that is committed on exit unless an exception occurs.
+    '''
+    if g.get('db_transaction') is not None:
+        yield
+        return
+    connections = g.db_transaction = {}
+    committed = False
+    try:
+        yield
+        for connection in connections.values():
+            connection.commit()
+        committed = True
+    finally:
+        g.db_transaction = None
+        for connection in connections.values():
+            if not committed:
+                connection.rollback()
+            get_pool().free_connection(connection)
+
+
 class WithDatabaseCursor:
-    def __init__(self, database, as_dict=False):
+    def __init__(self, database, as_dict=False, readonly=None):
         self.database = database
         self.as_dict = as_dict
+        self.readonly = readonly
     
     def __enter__(self):
-        self.wdb = WithDatabaseConnection(self.database)
+        self.wdb = WithDatabaseConnection(self.database, readonly=self.readonly,
+                                          defer_timeout=True)
         connection = self.wdb.__enter__()
         if self.as_dict:
-            self.cursor = connection.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
+            self.cursor = connection.cursor(cursor_factory=TimeoutDictCursor)
         else:
-            self.cursor = connection.cursor()
+            self.cursor = connection.cursor(cursor_factory=TimeoutCursor)
+        # Saves a round trip for each cursor
+        self.cursor.statement_timeout = self.wdb.timeout
         return self.cursor.__enter__()
 
     def __exit__(self, x, y, z):
@@ -102,16 +519,58 @@ class WithDatabaseCursor:
         self.wdb = self.cursor = None
 
 
-def get_db(database):
-    return WithDatabaseConnection(database)
+def get_db(database, readonly=None):
+    return WithDatabaseConnection(database, readonly=readonly)
 
 
-def get_cursor(database, as_dict=False):
+def get_cursor(database, as_dict=False, readonly=None):
+    '''
+    Return a context manager giving a cursor on a pooled connection. The
+    transaction is committed on exit unless an exception occurs.
+    Read-only cursors (default for GET requests) can be sent to a read
+    replica.
+    '''
     return WithDatabaseCursor(database,
-                              as_dict=as_dict)
+                              as_dict=as_dict,
+                              readonly=readonly)
+
+
+def get_pool(app=None):
+    '''
+    Return the connection pool of the application for the current
+    process. Pools are created lazily because connections and locks
+    must not be shared between worker processes forked by gunicorn.
+    '''
+    if app is None:
+        app = current_app
+    pid = os.getpid()
+    pool = app.db_pools.get(pid)
+    if pool is None:
+        pool = app.db_pools.setdefault(pid, ConnectionPool(**app.db_pool_options))
+    return pool
+
+
+def close_pool(app):
+    '''
+    Close all the connections of the pool of the current process, for
+    instance when a worker process exits.
+    '''
+    pool = app.db_pools.pop(os.getpid(), None)
+    if pool is not None:
+        pool.close()
 
 
 def init_app(app):
-    app.db_pool = ConnectionPool()
+    app.db_pool_options = dict(
+        primary=bv_rest.config.postgres_host,
+        replicas=bv_rest.config.postgres_replicas,
+        balancing=app.config.get('POSTGRES_BALANCING', 'round_robin'),
+        max_replication_lag=app.config.get('POSTGRES_MAX_REPLICATION_LAG', 5),
+        max_connections=app.config.get('POSTGRES_MAX_CONNECTIONS',
+                                       app.config.get('THREADS', bv_rest.config.threads)),
+        connect_timeout=app.config.get('POSTGRES_CONNECT_TIMEOUT', 2))
+    app.db_pools = {}
     app.postgres_user = bv_rest.config.postgres_user
     app.postgres_password = bv_rest.config.postgres_password
+    app.db_listener = Listener(app.postgres_user, app.postgres_password,
+                               host=bv_rest.config.postgres_host)
@@ -0,0 +1,94 @@
+'''
+Change feed sent to clients as Server-Sent Events. Row level triggers
+send a JSON payload on the row_changed channel for each modified row.
+In each process, a single LISTEN subscription dispatches these events
+to the queues of all connected clients.
+'''
+
+import json
+import queue
+import threading
+
+from flask import current_app
+
+class EventHub:
+    def __init__(self, database='bv_services', channel='row_changed',
+                 max_queue=1000):
+        self.database = database
+        self.channel = channel
+        self.max_queue = max_queue
+        self.lock = threading.Lock()
+        self.queues = []
+
+    def subscribe(self):
+        '''
+        Return a new queue receiving all events. Events are dictionaries
+        with table, operation and key items. None is put in the queue
+        when events may have been lost (e.g. after a reconnection to
+        the database or when the client is too slow).
+        '''
+        events = queue.Queue(self.max_queue)
+        with self.lock:
+            self.queues.append(events)
+        current_app.db_listener.listen(self.database, self.channel, self.dispatch)
+        return events
+
+    def unsubscribe(self, events):
+        with self.lock:
+            self.queues.remove(events)
+
+    def dispatch(self, payload):
+        event = (None if payload is None else json.loads(payload))
+        with self.lock:
+            queues = list(self.queues)
+        for events in queues:
+            try:
+                events.put_nowait(event)
+            except queue.Full:
+                # Drop pending events of a slow client and tell it
+                # to reload everything.
+                try:
+                    while True:
+                        events.get_nowait()
+                except queue.Empty:
+                    pass
+                events.put_nowait(None)
+
+
+def is_visible(event, login, roles):
+    '''
+    Identity administrators see all events, other users only see events
+    about their own identity, sessions and grantings.
+    '''
+    if 'identity_admin' in roles:
+        return True
+    key = event['key']
+    return key.get('login') == login or key.get('given_to') == '$' + login
+
+
+def event_stream(events, login, get_roles, keepalive=15):
+    '''
+    Generate Server-Sent Events from a queue of EventHub events. A
+    comment is sent every keepalive seconds without event to keep the
+    connection open and to detect disconnected clients. get_roles is
+    called before each event or keepalive to filter events with the
+    current roles of the user, the stream ends when the user is no
+    longer active.
+    '''
+    yield 'retry: 5000\n\n'
+    while True:
+        try:
+            event = events.get(timeout=keepalive)
+            timed_out = False
+        except queue.Empty:
+            timed_out = True
+        roles = get_roles()
+        if 'active' not in roles:
+            yield 'event: end\ndata: {}\n\n'
+            return
+        if timed_out:
+            yield ': keepalive\n\n'
+        elif event is None:
+            yield 'event: reset\ndata: {}\n\n'
+        elif is_visible(event, login, roles):
+            yield 'event: %s\ndata: %s\n\n' % (event['table'], json.dumps(event))
@@ -0,0 +1,111 @@
+'''
+Gunicorn configuration for production serving of bv_rest services:
+
+    gunicorn -c python:bv_rest.gunicorn_config bv_auth.wsgi
+
+The application is loaded and warmed up (see RestAPI.warm_up) in the
+master process before workers are forked. Database pools and listeners
+are created lazily in each worker. The following environment variables
+can be used:
+
+- BV_BIND: address to listen to (default 0.0.0.0:80)
+- BV_WORKERS_PER_CORE: number of worker processes per CPU core (default 2)
+- BV_THREADS: number of threads serving requests per worker (default 4)
+- BV_EVENT_STREAMS: number of /events streams per worker (default 16).
+  Each stream has a thread that waits for changes, a server accepts
+  workers * BV_EVENT_STREAMS subscribers. Idle streams use no database
+  connection.
+- BV_POSTGRES_CONNECTIONS: maximum number of connections that all the
+  workers of this server can open to a PostgreSQL server (default 40).
+  The number of workers is reduced to stay within this limit. With
+  several containers, their sum must be lower than max_connections of
+  PostgreSQL.
+- BV_DRAIN_DELAY: seconds during which requests are still served after
+  SIGTERM while /ready reports that the service is stopping, to let the
+  load balancer remove it (default 10)
+- BV_DRAIN_FILE: file marking a stopping service (default
+  /tmp/bv_rest_draining)
+
+After the drain delay, workers stop accepting connections and finish
+in-flight requests within graceful_timeout seconds.
+'''
+
+import multiprocessing
+import os
+import signal
+import threading
+
+import psycopg2
+
+import bv_rest
+import bv_rest.catalog
+import bv_rest.database
+
+bind = os.environ.get('BV_BIND', '0.0.0.0:80')
+preload_app = True
+# The database connection pool and admission classes of a worker
+# are sized from the number of threads serving requests. /events
+# streams have their own threads.
+worker_class = 'gthread'
+threads = bv_rest.config.threads + bv_rest.config.event_streams
+# A worker has one pooled connection per thread serving requests and
+# LISTEN connections for bv_services and for the databases cached by
+# bv_rest.catalog.
+connections_per_worker = bv_rest.config.threads + 1 + bv_rest.catalog.max_databases
+max_connections = int(os.environ.get('BV_POSTGRES_CONNECTIONS', '40'))
+workers = max(1, min(int(float(os.environ.get('BV_WORKERS_PER_CORE', '2')) * multiprocessing.cpu_count()),
+                     max_connections // connections_per_worker))
+# The API key is sent in the "api_key" header. Recent gunicorn versions
+# drop headers containing underscores unless this is set.
+header_map = 'dangerous'
+graceful_timeout = 30
+drain_delay = float(os.environ.get('BV_DRAIN_DELAY', '10'))
+
+
+def on_starting(server):
+    if os.path.exists(bv_rest.config.drain_file):
+        os.remove(bv_rest.config.drain_file)
+    handle_term = server.handle_term
+
+    def drain_then_term():
+        if os.path.exists(bv_rest.config.drain_file):
+            handle_term()
+        server.log.info('Draining for %s seconds', drain_delay)
+        open(bv_rest.config.drain_file, 'w').close()
+        # The master process is stopped by a second SIGTERM
+        timer = threading.Timer(drain_delay, os.kill, [os.getpid(), signal.SIGTERM])
+        timer.daemon = True
+        timer.start()
+
+    server.handle_term = drain_then_term
+
+
+def when_ready(server):
+    # Warn if the server cannot accept the connections of all workers
+    try:
+        connection = bv_rest.database.connect(bv_rest.config.postgres_host, 'bv_services',
+                                              bv_rest.config.postgres_user,
+                                              bv_rest.config.postgres_password,
+                                              connect_timeout=2)
+        try:
+            with connection.cursor() as cur:
+                cur.execute("SELECT current_setting('max_connections')::int - current_setting('superuser_reserved_connections')::int")
+                available = cur.fetchone()[0]
+        finally:
+            connection.close()
+    except (OSError, psycopg2.Error) as e:
+        server.log.warning('Cannot check PostgreSQL max_connections: %s', e)
+        return
+    needed = workers * connections_per_worker
+    if needed > available:
+        server.log.warning('%d workers may open %d PostgreSQL connections but the server accepts only %d',
+                           workers, needed, available)
+
+
+def on_exit(server):
+    if os.path.exists(bv_rest.config.drain_file):
+        os.remove(bv_rest.config.drain_file)
+
+
+def worker_exit(server, worker):
+    bv_rest.database.close_pool(worker.wsgi)
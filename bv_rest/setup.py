@@ -29,11 +29,16 @@ setup(
         'gunicorn',
         #'pgpy',
     ],
-    #extras_require={
-        #'testing': [
+    extras_require={
+        'asgi': [
+            'flask >= 2.0',
+            'aiopg',
+            'uvicorn',
+        ],
+        'testing': [
             ##'WebTest >= 1.3.1',  # py3 compat
-            ##'pytest',
+            'pytest',
             ##'pytest-cov',
-        #],
-    #},
+        ],
+    },
 )
@@ -0,0 +1,77 @@
+import threading
+import time
+
+from bv_rest.admission import AdmissionClass, default_admission_classes
+
+
+def test_try_acquire_never_waits():
+    admission = AdmissionClass('test', max_concurrency=1, max_queue=1)
+    assert admission.try_acquire()
+    assert not admission.try_acquire()
+    admission.release()
+    assert admission.try_acquire()
+
+
+def test_acquire_rejects_when_queue_is_full():
+    admission = AdmissionClass('test', max_concurrency=1, max_queue=0)
+    assert admission.acquire()
+    assert not admission.acquire(timeout=10)
+    state = admission.state()
+    assert state['active'] == 1
+    assert state['rejected'] == 1
+    assert state['timed_out'] == 0
+
+
+def test_acquire_times_out_in_queue():
+    admission = AdmissionClass('test', max_concurrency=1, max_queue=1)
+    assert admission.acquire()
+    start = time.monotonic()
+    assert not admission.acquire(timeout=0.05)
+    assert time.monotonic() - start >= 0.05
+    state = admission.state()
+    assert state['timed_out'] == 1
+    assert state['waiting'] == 0
+
+
+def test_queued_request_is_admitted_on_release():
+    admission = AdmissionClass('test', max_concurrency=1, max_queue=1)
+    assert admission.acquire()
+    result = []
+    thread = threading.Thread(target=lambda: result.append(admission.acquire(timeout=5)))
+    thread.start()
+    while admission.state()['waiting'] == 0:
+        time.sleep(0.001)
+    admission.release()
+    thread.join()
+    assert result == [True]
+    assert admission.state()['active'] == 1
+    assert admission.state()['admitted'] == 2
+
+
+def check_classes(classes, threads):
+    for name, parameters in classes.items():
+        assert parameters['max_concurrency'] >= 1, name
+        if name not in ('probe', 'events'):
+            # A thread is left for other classes
+            assert parameters['max_concurrency'] + parameters['max_queue'] < max(2, threads), name
+    expensive = classes['expensive']
+    assert expensive['max_concurrency'] + expensive['max_queue'] <= max(1, threads // 2)
+
+
+def test_default_admission_classes():
+    classes = default_admission_classes(4, 4, 16)
+    check_classes(classes, 4)
+    assert classes['read']['max_concurrency'] == 3
+    assert classes['default']['max_concurrency'] == 2
+    assert classes['expensive']['max_concurrency'] == 1
+    assert classes['import']['max_concurrency'] == 1
+    assert classes['events']['max_concurrency'] == 16
+    assert classes['probe']['max_concurrency'] == 4
+    for threads in (1, 2, 3, 8, 16):
+        check_classes(default_admission_classes(threads, threads, 1), threads)
+
+
+def test_default_admission_classes_bounded_by_connections():
+    classes = default_admission_classes(8, 2, 16)
+    assert classes['read']['max_concurrency'] == 2
+    assert classes['default']['max_concurrency'] == 2
@@ -0,0 +1,50 @@
+import bv_rest.cache
+from bv_rest.cache import Cache
+
+
+def test_get_and_set():
+    cache = Cache()
+    assert cache.get('a') is Cache.missing
+    cache.set('a', 1, cache.generation)
+    assert cache.get('a') == 1
+
+
+def test_value_computed_before_clear_is_not_stored():
+    cache = Cache()
+    generation = cache.generation
+    cache.clear()
+    cache.set('a', 1, generation)
+    assert cache.get('a') is Cache.missing
+    cache.set('a', 2, cache.generation)
+    assert cache.get('a') == 2
+
+
+def test_value_computed_before_pop_is_not_stored():
+    cache = Cache()
+    generation = cache.generation
+    cache.pop('b')
+    cache.set('a', 1, generation)
+    assert cache.get('a') is Cache.missing
+
+
+def test_lru_eviction():
+    cache = Cache(maxsize=2)
+    cache.set('a', 1, cache.generation)
+    cache.set('b', 2, cache.generation)
+    cache.get('a')
+    cache.set('c', 3, cache.generation)
+    assert cache.get('a') == 1
+    assert cache.get('b') is Cache.missing
+    assert cache.get('c') == 3
+
+
+def test_ttl(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(bv_rest.cache.time, 'monotonic', lambda: now[0])
+    cache = Cache(ttl=10)
+    cache.set('a', 1, cache.generation)
+    now[0] += 9
+    assert cache.get('a') == 1
+    now[0] += 2
+    assert cache.get('a') is Cache.missing
+    assert 'a' not in cache.entries
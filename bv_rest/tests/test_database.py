@@ -0,0 +1,37 @@
+import time
+
+from bv_rest.database import ConnectionPool
+
+
+def test_select_host_without_replica():
+    pool = ConnectionPool(primary='primary')
+    assert pool.select_host(readonly=False) == 'primary'
+    assert pool.select_host(readonly=True) == 'primary'
+
+
+def test_select_host_round_robin():
+    pool = ConnectionPool(primary='primary', replicas=['r1', 'r2'])
+    assert pool.select_host(readonly=False) == 'primary'
+    hosts = [pool.select_host(readonly=True) for i in range(4)]
+    assert sorted(hosts) == ['r1', 'r1', 'r2', 'r2']
+    assert hosts[0] != hosts[1]
+
+
+def test_select_host_least_connections():
+    pool = ConnectionPool(primary='primary', replicas=['r1', 'r2'],
+                          balancing='least_connections')
+    pool.in_use.append(pool.ConnectionRecord('r1', 'db', 0, 0, None))
+    assert pool.select_host(readonly=True) == 'r2'
+    pool.in_use.append(pool.ConnectionRecord('r2', 'db', 0, 0, None))
+    pool.in_use.append(pool.ConnectionRecord('r2', 'db', 0, 0, None))
+    assert pool.select_host(readonly=True) == 'r1'
+
+
+def test_select_host_skips_lagging_replica():
+    pool = ConnectionPool(primary='primary', replicas=['r1', 'r2'],
+                          lag_check_interval=60)
+    pool.replica_state['r1'] = (time.time(), False)
+    assert {pool.select_host(readonly=True) for i in range(4)} == {'r2'}
+    pool.replica_state['r2'] = (time.time(), False)
+    assert pool.select_host(readonly=True) == 'primary'
+
@@ -0,0 +1,44 @@
+import json
+import queue
+
+from bv_rest.events import event_stream, is_visible
+
+
+def event(table, **key):
+    return {'table': table, 'operation': 'UPDATE', 'key': key}
+
+
+def test_is_visible():
+    assert is_visible(event('identity', login='bob'), 'admin', {'identity_admin'})
+    assert is_visible(event('identity', login='bob'), 'bob', {'active'})
+    assert is_visible(event('granting', role='active', given_to='$bob'), 'bob', {'active'})
+    assert not is_visible(event('identity', login='alice'), 'bob', {'active'})
+    assert not is_visible(event('granting', role='active', given_to='$alice'), 'bob', {'active'})
+
+
+def test_event_stream():
+    events = queue.Queue()
+    events.put(event('session', login='bob'))
+    events.put(event('session', login='alice'))
+    events.put(None)
+    stream = event_stream(events, 'bob', lambda: {'active'}, keepalive=0.01)
+    assert next(stream) == 'retry: 5000\n\n'
+    message = next(stream)
+    assert message.startswith('event: session\ndata: ')
+    assert json.loads(message.split('data: ', 1)[1]) == event('session', login='bob')
+    # The event about alice is not sent
+    assert next(stream) == 'event: reset\ndata: {}\n\n'
+    assert next(stream) == ': keepalive\n\n'
+
+
+def test_event_stream_uses_current_roles():
+    events = queue.Queue()
+    roles = [{'active'}]
+    stream = event_stream(events, 'bob', lambda: roles[0], keepalive=0.01)
+    next(stream)
+    events.put(event('identity', login='alice'))
+    roles[0] = {'active', 'identity_admin'}
+    assert next(stream).startswith('event: identity\n')
+    roles[0] = set()
+    assert next(stream) == 'event: end\ndata: {}\n\n'
+    assert list(stream) == []